@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""
+Time reading and drawing pages with `gless --bench` on generated bed and bedGraph files
+of increasing sizes, with -n and -b.
+
+Usage: python bench_pages.py [-s 4,5,6] [-p npages] [-d directory] [gless options]
+The files have 10^4, 10^5 and 10^6 lines by default (-s gives the powers of ten, up to 8),
+and are generated once in the directory (by default in the temporary directory).
+Drawing needs a display: run it with `xvfb-run` on a machine without one.
+"""
+
+import os,sys,random,tempfile,subprocess,argparse
+from bench_parser import make_bedgraph
+
+GLESS = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','gless.py')
+
+def make_bed(path,nlines):
+    random.seed(0)
+    with open(path,'w') as f:
+        pos = 0
+        for n in xrange(nlines):
+            pos += random.randint(0,200)
+            f.write("chr1\t%d\t%d\tfeat%d\n" % (pos,pos+random.randint(1,500),n))
+
+def fixture(directory,fmt,nlines):
+    """Return the path of the file with *nlines* lines of format *fmt*, creating it if needed."""
+    path = os.path.join(directory,'bench_1e%d.%s' % (len(str(nlines))-1,fmt))
+    if not os.path.exists(path):
+        print >>sys.stderr, "Generating %s" % path
+        (make_bed if fmt == 'bed' else make_bedgraph)(path,nlines)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gless on generated files.")
+    parser.add_argument('-s','--sizes', default='4,5,6',
+                        help="Powers of ten of the numbers of lines. [4,5,6]")
+    parser.add_argument('-p','--pages', default=50, type=int, help="Number of pages. [50]")
+    parser.add_argument('-d','--dir', default=os.path.join(tempfile.gettempdir(),'gless_bench'),
+                        help="Where the files are generated.")
+    args,options = parser.parse_known_args()
+    if not os.path.exists(args.dir): os.makedirs(args.dir)
+    for k in map(int,args.sizes.split(',')):
+        for fmt in ['bed','bedGraph']:
+            path = fixture(args.dir,fmt,10**k)
+            for mode in [['-n','100'],['-b','100000']]:
+                cmd = [sys.executable,GLESS,'--bench',str(args.pages)] + mode + options + [path]
+                out = subprocess.check_output(cmd).splitlines()
+                print "%s %s: %s" % (os.path.basename(path),' '.join(mode),'; '.join(out[-2:]))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""
+Compare the speed of `gless.Parser` with the former line-by-line `csv.reader` parser.
+
+Usage: python bench_parser.py [file.bed|file.bedGraph] ...
+Without argument, a bedGraph of 10^6 lines is generated in a temporary directory.
+"""
+
+import os,sys,csv,time,random,tempfile
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import gless
+
+def csv_parser(path):
+    """The parser used before, kept here as a reference."""
+    fmt = os.path.splitext(path)[1][1:]
+    with open(path) as f:
+        reader = csv.reader(f,delimiter='\t',quotechar='|')
+        line0 = reader.next()
+        nfields = len(line0)
+        if not line0[0].startswith("track") or line0[0].startswith("#"): f.seek(0)
+        fun = float if fmt.lower()=='bedgraph' else lambda x:x
+        for line in reader:
+            chr,start,end = (line[0],int(line[1]),int(line[2]))
+            other = fun(line[3]) if nfields > 3 else "00"
+            yield (chr,start,end,other)
+
+def make_bedgraph(path,nlines):
+    random.seed(0)
+    with open(path,'w') as f:
+        pos = 0
+        for n in xrange(nlines):
+            start = pos + random.randint(0,20)
+            pos = start + random.randint(1,30)
+            f.write("chr1\t%d\t%d\t%.2f\n" % (start,pos,random.random()*10))
+
+def timeit(stream):
+    t0 = time.time()
+    n = sum(1 for _ in stream)
+    return n, time.time()-t0
+
+def main():
+    files = sys.argv[1:]
+    if not files:
+        files = [os.path.join(tempfile.mkdtemp(),'bench.bedGraph')]
+        make_bedgraph(files[0],10**6)
+    for path in files:
+        n,t_csv = timeit(csv_parser(path))
+        n,t_new = timeit(gless.Parser(path).read())
+        print "%s: %d lines" % (os.path.basename(path),n)
+        print "  csv.reader: %.2fs (%d lines/s)" % (t_csv,n/t_csv)
+        print "  Parser:     %.2fs (%d lines/s), x%.1f" % (t_new,n/t_new,t_csv/t_new)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,25 +9,72 @@ your files that is probably telling more than columns of numbers.
 
 If the library `bbcflib` is found on your system, `track` will be used and will
 recognize .bed, .bedgraph, .wig, .sga, .bigWig, .sql, .sam formats. Else it can still
-read .bed and .bedGraph files.
+read .bed and .bedGraph files. These can also be compressed with gzip (.bed.gz,
+.bedGraph.gz); if they are compressed with `bgzip`, a table of the compressed blocks is
+saved as a hidden *.glx* file so that gless can seek in them without decompressing
+everything before.
 
-Since files are read sequentially (without loading temp in memory), it does not read
-backwards. Also the chromosomes names present in each file are not known in advance.
-The first file you give as input is taken as a reference. This can cause chromosomes
-to be skipped in the secondary files, if their names or order is different.
+Since files are read sequentially (without loading temp in memory), it can only go back
+to pages that were already displayed: the most recent ones are kept in memory (see -m),
+the older ones are read again from the position in the files saved with each page.
+The first file you give as input is taken as a reference for the order of the chromosomes.
+Each chromosome is shown once, in the order of the reference, then those that are only
+in the other files. If the files do not have the same chromosomes in the same order, they
+are moved to the beginning of each of them, using the table of their chromosomes kept in
+their index or binary copy (see below), so that chromosomes in a different order are not
+skipped in the secondary files, with -n as with -b.
+
+When a region is selected with -s, bed and bedGraph files are indexed once (the index
+is saved as a hidden *.gli* file next to the track, or in ~/.gless if the directory is
+not writable) so that gless can jump directly to the region instead of reading the file
+from the top: it records where to start reading for every 16 kb of each chromosome.
+The index is rebuilt automatically when the track file changes, or only extended with
+the new lines when it grows in follow mode (-f). To index files in advance, run
+`gless index <file> ...`.
+
+Files must be sorted by chromosome and start position. `gless sort <file> ...` (or the
+--sort option, for the files that are not) sorts them without loading them in memory,
+and saves the result as a hidden file next to the track, read instead of it as long
+as the track does not change.
+
+With -c (or --build-cache), bed and bedGraph files are also converted once to a compact
+binary format (saved next to the track as a hidden *.glb* file), which is read through
+a memory map instead of being parsed. It is used automatically as long as it is
+up to date. For bedGraph files, zoom levels summarizing the scores in bins of 10x,
+100x, ... the mean feature length are saved as well (*.glz1*, *.glz2*, ...): with -b,
+gless reads the coarsest level that still has one bin per pixel instead of the features.
+
+With -f, gless follows files that are still being written, like `tail -f`: when the
+last page is displayed and the files grow, it is read again with the new features, and
+the next pages become available. A track given as `-` is read from the standard input,
+which is copied to a temporary file as it comes; it implies -f.
 
 Usage
 =====
-Press the SPACE bar to read forward, RETURN (or Delete) to return to the beginning,
-ESC to quit. Move the cursor on elements to display their name/score.
+Press the SPACE bar to read forward, the LEFT arrow to go back one page, RETURN (or Delete)
+to return to the beginning, ESC to quit. Move the cursor on elements to display their name/score.
 
 Options:
 
 * -n nfeat: display the next *nfeat* features (from all tracks together).
 * -b nbp: display the next *nbp* base pairs window.
 * -y ylim: set the vertical scale for numeric tracks: either `<min>,<max>` or just `<max>`.
+  By default, it goes from the 0.1% to the 99.9% quantile of the scores of each bedGraph
+  (computed once and saved as a hidden *.gls* file, see `Stats`), with 0 in it.
 * -s sel: selection: either a chromosome name, or a region specified as <chr>:<start>.
   The right bound is set by the -n/-b argument."
+* -m memory: maximum memory (in MB) used to keep the pages already seen, and (a quarter of it)
+  the positions in the files to read them again. Default 100.
+* -j jobs: with -b, read the tracks in parallel in *jobs* processes. Default 1.
+* -f: follow the files as they grow (see above).
+* --sort: sort the files that are not (see above).
+* -c: create a binary copy of the files that are read, if they do not have one yet.
+* --bench [npages]: read and draw *npages* pages without waiting for keys, and print
+  the time spent on each (see `Gless.bench`).
+* --profile [prefix]: time each stage of the pages and count features and canvas items,
+  show it in the right margin, and save it at exit in <prefix>.json and <prefix>.prof
+  (see `Profile`). Also enabled by the environment variable GLESS_PROFILE=<prefix>.
+* --build-cache: only create (or update) the binary copy of the files, and exit.
 
 Known issues:
 =============
@@ -39,40 +86,166 @@ Known issues:
 """
 
 import Tkinter as tk
-import os,sys
+import os,sys,time,math,threading,multiprocessing
 import argparse,re
-import csv
+import json,bisect,heapq,struct,gzip,zlib,tempfile,shutil,atexit
+import array,ctypes,mmap
+import itertools,operator,cProfile,cPickle
+from collections import OrderedDict,deque,Counter
+try: import resource
+except ImportError: resource = None # not on Windows
 
 ###############################################################################
 
 class Parser(object):
     #A replacement for track when bbcflib is not found, able to parse
     #bed and bedGraph formats only. Called in the Reader class."""
+    blocksize = 2**16 # size of the blocks read at once, in bytes
+
     def __init__(self,filename):
         self.path = os.path.abspath(filename)
-        self.format = os.path.splitext(filename)[1][1:]
-        self.fields = ['chr','start','end','other']
+        self.format = track_format(filename)
+        self.fields = ['chr','start','end','score' if self.format.lower()=='bedgraph' else 'name']
+        self.file = None
+        self.block = ''    # current block of complete lines
+        self.base = 0      # position of the current block in the file
+        self.feats = iter([]) # iterator over the features of the current block
+        self.nfeats = 0    # number of features in the current block
+        self.lines = None  # number of lines up to each feature of the block, if not one per line
+        self.skip = None   # (chrom,start) of the selection, until a feature reaches it
+        self.follow = False # whether the file is still being written (see `Gless.poll`)
+        self.header = None # (number of columns, offset of the first line after the header)
     def __enter__(self):
         return self
     def __exit__(self,errtype,value,traceback):
-        pass
-    def read(self,fields=None,selection=None):
-        with open(self.path) as f:
-            reader = csv.reader(f,delimiter='\t',quotechar='|')
-            line0 = reader.next()
-            nfields = len(line0)
-            if not line0[0].startswith("track") or line0[0].startswith("#"): f.seek(0)
-            fun = float if self.format.lower()=='bedgraph' else lambda x:x
-            for line in reader:
-                try:
-                    chr,start,end = (line[0],int(line[1]),int(line[2]))
-                    other = fun(line[3]) if nfields > 3 else "00"
-                except (IndexError,ValueError):
-                    sys.exit(("Library 'bbcflib' not found. "
-                              "Only 'bed' and 'bedGraph' formats available. "
-                              "Wrong line in file %s:\n%s"
-                              % (os.path.basename(self.path),'\t'.join(line)) ))
-                yield (chr,start,end,other)
+        if self.file: self.file.close()
+    @property
+    def offset(self):
+        """Position in the file right after the last feature read."""
+        nread = self.nfeats - self.feats.__length_hint__()
+        if self.lines is not None:
+            nread = self.lines[nread-1] if nread else 0
+        lines = self.block.split('\n',nread)
+        if len(lines) <= nread: return self.base + len(self.block)
+        return self.base + len(self.block) - len(lines[-1])
+    def read(self,fields=None,selection=None,offset=None):
+        """Only the columns in *fields* are converted: the 4th one ('name' or 'score')
+           is left out if it is not asked for.
+           If a *selection* {'chr':'chr1','start':(12,12)} is given, start reading at the
+           first feature of that region, using the sidecar index (see `Index`). The lines
+           that end before it are dropped before making features of them.
+           If an *offset* is given, resume reading at this position in the file.
+           The file is opened only once: all streams share the same file object,
+           so only the last one returned can be used. Its first line is read only the
+           first time, since going back to it means decompressing a gzip file again."""
+        if self.file is None:
+            self.file = open_file(self.path)
+        f = self.file
+        if self.header is None:
+            f.seek(0)
+            line0 = f.readline().rstrip('\r\n').split('\t')
+            if line0 == ['']: return iter([]) # empty file
+            self.header = (len(line0),f.tell() if line0[0].startswith("track") else 0)
+        nfields,first = self.header
+        if fields is not None and not ('name' in fields or 'score' in fields):
+            nfields = min(nfields,3)
+        self.skip = None
+        if offset is not None:
+            f.seek(offset)
+        elif selection:
+            start = selection.get('start',[0])[0]
+            offset = Index(self.path).load(self.follow).seek(selection['chr'],start)
+            if offset is None: return iter([]) # chromosome not in this file, or before *start*
+            f.seek(offset)
+            if start: self.skip = (selection['chr'],start)
+        else:
+            f.seek(first)
+        self.base = f.tell()
+        self.block = ''
+        self.feats = iter([])
+        self.nfeats = 0
+        self.lines = None
+        return itertools.chain.from_iterable(self.parse(f,nfields))
+    def parse(self,f,nfields):
+        """Yield an iterator over the tuples (chr,start,end,other) of each block of *f*.
+           The file is read by large blocks, and each column of a block is converted at once."""
+        rest = ''
+        while True:
+            data = f.read(self.blocksize)
+            block = rest + data
+            if data:
+                cut = block.rfind('\n')+1
+                block,rest = block[:cut],block[cut:]
+            elif self.follow:
+                block = '' # the last line may not be complete yet
+            if not block:
+                if data: continue # no complete line yet
+                return
+            if profile: t = time.time()
+            feats,lines = self.tokenize(block,nfields,self.skip)
+            if profile: profile.add('parse',time.time()-t)
+            if feats: self.skip = None
+            self.base += len(self.block)
+            self.block = block
+            self.feats = iter(feats)
+            self.nfeats = len(feats)
+            self.lines = lines
+            yield self.feats
+    def ints(self,column):
+        """Convert a list of strings to integers all at once, which is much faster than
+           calling int() on each. Raise ValueError if it is not only integers."""
+        column = ','.join(column)
+        if column.translate(None,'0123456789-,'): raise ValueError
+        return json.loads('['+column+']')
+    def tokenize(self,block,nfields,skip=None):
+        """Return the list of features (chr,start,end,other) in a *block* of complete lines,
+           and None, or the number of lines up to each feature if some lines are blank or
+           skipped. With *nfields* = 3, the 4th column is replaced by "00". If *skip* is
+           (chrom,start), the first lines on *chrom* that end before *start* are dropped.
+           Splitting the whole block at once is faster than splitting each line only up
+           to the columns needed, so all columns are split, but only these are converted."""
+        fun = float if self.format.lower()=='bedgraph' else str
+        block = block.replace('\r','')
+        if block.endswith('\n'): block = block[:-1]
+        lines = block.split('\n')
+        ntabs = set(map(operator.methodcaller('count','\t'),lines))
+        if len(ntabs) == 1: # same number of columns on every line: split all at once
+            k = ntabs.pop()+1
+            fields = block.replace('\n','\t').split('\t')
+            try:
+                if k < 3 or (nfields > 3 and k < 4): raise IndexError
+                chroms = fields[0::k]
+                starts = self.ints(fields[1::k])
+                ends = self.ints(fields[2::k])
+                i = 0
+                if skip:
+                    chrom,start = skip
+                    while i < len(ends) and chroms[i] == chrom and ends[i] <= start: i += 1
+                    chroms,starts,ends = (chroms[i:],starts[i:],ends[i:])
+                if nfields <= 3: others = itertools.repeat("00")
+                elif fun is float: others = map(float,fields[3+i*k::k])
+                else: others = fields[3+i*k::k]
+                feats = zip(map(intern,chroms),starts,ends,others)
+                return feats, range(i+1,i+1+len(feats)) if i else None
+            except (IndexError,ValueError):
+                pass # find the wrong line below
+        feats = []
+        nlines = []
+        for n,line in enumerate(lines):
+            line = line.split('\t',min(nfields,4))
+            if line == ['']: continue
+            try:
+                chr,start,end = (intern(line[0]),int(line[1]),int(line[2]))
+                if skip and not feats and chr == skip[0] and end <= skip[1]: continue
+                other = fun(line[3]) if nfields > 3 else "00"
+            except (IndexError,ValueError):
+                sys.exit(("Library 'bbcflib' not found. "
+                          "Only 'bed' and 'bedGraph' formats available. "
+                          "Wrong line in file %s:\n%s"
+                          % (os.path.basename(self.path),'\t'.join(line)) ))
+            feats.append((chr,start,end,other))
+            nlines.append(n+1)
+        return feats, nlines
 
 try:
     from bbcflib.track import track
@@ -82,202 +255,1981 @@ except ImportError:
 
 ###############################################################################
 
-class Memory(object): # Not working yet
-    def __init__(self):
-        self.content = []
-        self.chrom = None
-        self.limit = 10
+def cache_path(path,ext):
+    """Return the path of a sidecar file with extension *ext* for the track *path*:
+       a hidden file next to the track if its directory is writable, else in ~/.gless."""
+    dirname,basename = os.path.split(os.path.abspath(path))
+    if os.access(dirname,os.W_OK):
+        return os.path.join(dirname,'.'+basename+ext)
+    cachedir = os.path.join(os.path.expanduser('~'),'.gless')
+    if not os.path.exists(cachedir): os.makedirs(cachedir)
+    return os.path.join(cachedir,dirname.strip(os.sep).replace(os.sep,'_')+'_'+basename+ext)
+
+def track_format(filename):
+    """Return the format of a track from its file name, e.g. 'bed' for 'x.bed' or 'x.bed.gz'."""
+    if filename.endswith('.gz'): filename = filename[:-3]
+    return os.path.splitext(filename)[1][1:]
+
+def open_file(path):
+    """Open the track file *path* for reading. Gzip files are decompressed on the fly:
+       if they are BGZF (see `Bgzf`) they can seek anywhere quickly, else seeking back
+       decompresses them again from the start."""
+    if path.endswith('.gz'):
+        if Bgzf.check(path): return Bgzf(path)
+        return gzip.open(path,'rb')
+    return open(path,'rb')
+
+class Index(object):
+    """Byte offsets index of a bed/bedGraph file, to seek directly to a region.
+
+    Like the linear index of tabix, each chromosome is cut in bins of *binsize* bp, and
+    for each bin it stores the offset of the first line of the chromosome that ends after
+    the start of the bin: all the lines before it can be skipped. The bins are saved as
+    arrays of integers in a binary sidecar file, after a JSON header with the position of
+    the array of each chromosome, so that a query reads the header and a single number.
+    The header is also the table of contents of the file: where each chromosome starts
+    and ends, and its number of features, and it tells whether the file is sorted
+    (see `sort_track`).
+    It is rebuilt when the track's size or modification time changes, unless the track
+    is followed as it grows: then only the lines added since are indexed."""
+    magic = 'GLESSIDX'
+    version = 5
+    binsize = 2**14
+
+    def __init__(self,path):
+        self.path = os.path.abspath(path)
+        self.ipath = cache_path(self.path,'.gli')
+        self.chroms = {} # {chrom: [position of its bins in the file, number of bins,
+                         #          first offset, end offset, number of features]}
+        self.bins = {}   # {chrom: array of offsets}, if it was built and not read from disk
+        self.start = 0   # position of the arrays in the file
+        self.sorted = True # whether each chromosome is in one block, sorted by start
+        self.end = 0     # offset right after the last line indexed
+        self.read_stamp = None # stamp of the track when it was read, saved by `write`
+        self.last = [None,0,False] # chromosome and start of that line, and whether it was indexed
+        self.tail = [0,0]  # length and crc32 of the end of that line, to check that it is still there
+
+    def stamp(self):
+        st = os.stat(self.path)
+        return [st.st_size, int(st.st_mtime)]
+
+    def load(self,follow=False):
+        """Read the header of the index from disk, or (re)build it if it is missing or outdated.
+           If *follow* is True, the track is still being written: a line not complete yet
+           is not indexed, and if the track only grew since the index was saved, the lines
+           added are indexed instead of reading it all again."""
+        try:
+            with open(self.ipath,'rb') as f:
+                if f.read(len(self.magic)) == self.magic:
+                    size,self.start = struct.unpack('<QQ',f.read(16))
+                    header = json.loads(f.read(size))
+                    if header['version'] == self.version and header['byteorder'] == sys.byteorder:
+                        stamp = self.stamp()
+                        if header['stamp'] == stamp or (follow and header['end'] <= stamp[0]):
+                            self.chroms = header['chroms']
+                            self.sorted = header['sorted']
+                            self.end = header['end']
+                            self.last = header['last']
+                            self.tail = header['tail']
+                        if header['stamp'] == stamp: return self
+                        if self.chroms and not self.update(f): self.chroms = {}
+        except (IOError,OSError,ValueError,KeyError,struct.error):
+            self.chroms = {}
+        if not self.chroms: self.build(follow)
+        try:
+            self.write()
+        except (IOError,OSError):
+            pass # keep it in memory only
+        return self
+
+    def build(self,follow=False):
+        """Read the whole file once to record the offsets."""
+        self.chroms = {}
+        self.bins = {}
+        self.sorted = True
+        self.read_stamp = self.stamp() # before: the lines added while reading are indexed later
+        with open_file(self.path) as f:
+            self.scan(f,0,None,0,False,follow)
+        self.layout()
+
+    def update(self,f):
+        """Index the lines added at the end of the track since the index in the open file *f*
+           was saved, where they were left: the arrays of the bins are read to extend them.
+           Return False if the last line indexed is not there anymore: the track was
+           written again instead of growing."""
+        chrom,last,indexing = self.last
+        self.read_stamp = self.stamp()
+        with open_file(self.path) as t:
+            t.seek(self.end-self.tail[0])
+            if zlib.crc32(t.read(self.tail[0])) != self.tail[1]: return False
+            for chr,(pos,nbins,first,end,n) in self.chroms.iteritems():
+                self.bins[chr] = array.array('l')
+                f.seek(self.start + pos)
+                self.bins[chr].fromstring(f.read(nbins*self.bins[chr].itemsize))
+            self.scan(t,self.end,chrom,last,indexing,True)
+        self.layout()
+        return True
+
+    def scan(self,f,offset,chrom,last,indexing,follow):
+        """Index the lines of *f* from *offset*. *chrom*, *last* and *indexing* are the
+           chromosome and start of the previous line, and whether it was indexed."""
+        bins = self.bins.get(chrom)
+        tail = None
+        for line in f:
+            if follow and not line.endswith('\n'): break # still being written
+            tail = line[-64:]
+            fields = line.split('\t',3)
+            try: chr,start,end = (fields[0],int(fields[1]),int(fields[2]))
+            except (IndexError,ValueError): # header, comment or blank line
+                offset += len(line)
+                continue
+            if chr != chrom:
+                # if the file is unsorted, only the first block of a chromosome is indexed
+                indexing = chr not in self.bins
+                if indexing:
+                    self.bins[chr] = bins = array.array('l')
+                    self.chroms[chr] = [0,0,offset,offset,0]
+                else:
+                    self.sorted = False
+                chrom = chr
+            elif start < last:
+                self.sorted = False
+            last = start
+            if indexing:
+                while len(bins)*self.binsize < end:
+                    bins.append(offset)
+                self.chroms[chr][3] = offset+len(line)
+                self.chroms[chr][4] += 1
+            offset += len(line)
+        self.end = offset
+        self.last = [chrom,last,indexing]
+        if tail is not None: self.tail = [len(tail),zlib.crc32(tail)]
+
+    def layout(self):
+        """Place the arrays of the bins one after the other in the file."""
+        pos = 0
+        for chr,bins in self.bins.iteritems():
+            self.chroms[chr][:2] = [pos,len(bins)]
+            pos += len(bins)*bins.itemsize
+
+    def write(self):
+        """Save the index in its sidecar file."""
+        header = json.dumps({'version':self.version, 'stamp':self.read_stamp or self.stamp(),
+                             'sorted':self.sorted, 'byteorder':sys.byteorder,
+                             'chroms':self.chroms, 'end':self.end, 'last':self.last,
+                             'tail':self.tail})
+        self.start = len(self.magic) + 16 + len(header)
+        with open(self.ipath,'wb') as f:
+            f.write(self.magic)
+            f.write(struct.pack('<QQ',len(header),self.start))
+            f.write(header)
+            for chr in sorted(self.bins,key=lambda c: self.chroms[c][0]):
+                f.write(self.bins[chr].tostring())
+
+    def seek(self,chrom,start=0):
+        """Return the offset from which to read to reach the first feature of *chrom*
+           that ends after *start*, or None if *chrom* is not in the file, or if all its
+           features end before *start*."""
+        if chrom not in self.chroms: return None
+        pos,nbins,first,end,n = self.chroms[chrom]
+        k = start // self.binsize
+        if k >= nbins: return None
+        if chrom in self.bins: return self.bins[chrom][k]
+        offset = array.array('l')
+        with open(self.ipath,'rb') as f:
+            f.seek(self.start + pos + k*offset.itemsize)
+            offset.fromstring(f.read(offset.itemsize))
+        return offset[0]
+
+def sort_run(job):
+    """Sort a chunk of lines of a track in a process of `sort_track`. *job* is (text,tmpdir):
+       the sorted lines are written in a temporary file in *tmpdir*. Return its path, the
+       chromosomes in the order they first appear in *text*, {chrom: (start,end) offsets of
+       its lines in the file}, and the 'track' and 'browser' lines (the others are dropped)."""
+    text,tmpdir = job
+    rows = []
+    header = []
+    first = {} # {chrom: rank of its first appearance}
+    for line in text.splitlines(True):
+        fields = line.split('\t',3)
+        try: rows.append((intern(fields[0]),int(fields[1]),int(fields[2]),line))
+        except (IndexError,ValueError):
+            if line.startswith(('track','browser')): header.append(line)
+            continue
+        if fields[0] not in first: first[fields[0]] = len(first)
+    del text
+    rows.sort() # features at the same position are sorted by the rest of the line
+    fd,path = tempfile.mkstemp(dir=tmpdir)
+    segments = {}
+    with os.fdopen(fd,'wb') as f:
+        for chrom,group in itertools.groupby(rows,operator.itemgetter(0)):
+            a = f.tell()
+            for row in group:
+                f.write(row[3] if row[3].endswith('\n') else row[3]+'\n')
+            segments[chrom] = (a,f.tell())
+    return path, sorted(first,key=first.get), segments, header
+
+def merge_runs(runs,order,o):
+    """Merge the sorted *runs* (as returned by `sort_run`) into the file *o*, open for
+       writing, one chromosome at a time in *order*. Return {chrom: (start,end) offsets
+       of its lines in *o*}, like `sort_run`."""
+    def lines(f,a,b): # lines of one chromosome in a run, with their sorting key
+        f.seek(a)
+        while f.tell() < b:
+            line = f.readline()
+            fields = line.split('\t',3)
+            yield (int(fields[1]),int(fields[2]),line)
+    segments = {}
+    files = []
+    try:
+        for run in runs: files.append(open(run[0],'rb'))
+        for chrom in order:
+            merged = heapq.merge(*[lines(f,*run[2][chrom])
+                                   for f,run in zip(files,runs) if chrom in run[2]])
+            a = o.tell()
+            o.writelines(x[2] for x in merged)
+            if o.tell() > a: segments[chrom] = (a,o.tell())
+    finally:
+        for f in files: f.close()
+    return segments
+
+def sort_track(path,out=None,memory=100,jobs=1,fanin=128):
+    """Sort the track *path* by chromosome, in the order they first appear in it, then by
+       start, end and the rest of the line, and write it to *out* (by default, the hidden
+       copy that gless reads instead of the track, see `sorted_copy`). Return *out*.
+       It is an external merge sort: the file is cut in chunks that are sorted in *jobs*
+       processes and written to temporary files, which are then merged, so that about
+       *memory* MB are used whatever the size of the file. At most *fanin* files are
+       merged at once (each is kept open): if there are more, they are merged by groups
+       into larger temporary files first, as many times as needed."""
+    if out is None: out = cache_path(path,'.sorted.'+track_format(path))
+    chunksize = max(memory*2**20 // (10*jobs), 2**16) # a chunk takes about 10 times its size once parsed
+    tmpdir = tempfile.mkdtemp(prefix='gless',dir=os.path.dirname(os.path.abspath(out)))
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    runs = []
+    try:
+        pending = deque()
+        with open_file(path) as f:
+            while True:
+                text = f.read(chunksize)
+                if not text: break
+                text += f.readline()
+                if pool is None:
+                    runs.append(sort_run((text,tmpdir)))
+                    continue
+                if len(pending) >= jobs: # do not read more than the processes can take
+                    runs.append(pending.popleft().get())
+                pending.append(pool.apply_async(sort_run,((text,tmpdir),)))
+        runs.extend(p.get() for p in pending)
+        order = OrderedDict()
+        for run,chroms,segments,header in runs:
+            for c in chroms: order.setdefault(c,None)
+        header = runs[0][3][:1] if runs else [] # track line
+        while len(runs) > fanin:
+            merged = []
+            for i in range(0,len(runs),fanin):
+                fd,tmp = tempfile.mkstemp(dir=tmpdir)
+                with os.fdopen(fd,'wb') as o:
+                    merged.append((tmp,None,merge_runs(runs[i:i+fanin],order,o),None))
+                for run in runs[i:i+fanin]: os.remove(run[0])
+            runs = merged
+        with open(out+'.tmp','wb') as o:
+            o.writelines(header)
+            merge_runs(runs,order,o)
+        os.rename(out+'.tmp',out)
+    finally:
+        if pool is not None: pool.terminate()
+        shutil.rmtree(tmpdir,ignore_errors=True)
+    return out
+
+def sorted_copy(path):
+    """Return the path of the sorted copy of the track *path* made by `sort_track`,
+       or None if there is none or it is older than the track."""
+    out = cache_path(path,'.sorted.'+track_format(path))
+    if os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(path):
+        return out
+
+class Bgzf(object):
+    """Decompressed content of a BGZF file (as written by `bgzip`), as a read-only file.
+
+    BGZF is a series of gzip members, the blocks, each with at most 64 kB of data and its
+    compressed size in the header. A table of the position of each block in the file and
+    in the data is built once by reading the headers only, and saved as a sidecar file
+    like the `Index`. Offsets are counted in the decompressed data, so that `seek` just
+    finds the block by bisection and decompresses it."""
+    version = 1
+
+    def __init__(self,path):
+        self.path = os.path.abspath(path)
+        self.file = open(self.path,'rb')
+        self.blocks,self.starts = self.table()
+        self.k = -1     # number of the current block
+        self.block = '' # decompressed data of the current block
+        self.pos = 0    # position in the current block
+    def __enter__(self):
+        return self
+    def __exit__(self,errtype,value,traceback):
+        self.close()
+    def __iter__(self):
+        return iter(self.readline,'')
+    def close(self):
+        self.file.close()
+
+    @classmethod
+    def check(cls,path):
+        """Whether *path* is a BGZF file: a gzip file with a 'BC' field in its header."""
+        with open(path,'rb') as f:
+            header = f.read(18)
+        return len(header) == 18 and header[:4] == '\x1f\x8b\x08\x04' and header[12:14] == 'BC'
+
+    def header(self,offset):
+        """Return the size of the block at *offset* in the file, or None at the end."""
+        self.file.seek(offset)
+        header = self.file.read(12)
+        if len(header) < 12: return None
+        extra = self.file.read(struct.unpack('<H',header[10:12])[0])
+        i = 0
+        while i+4 <= len(extra): # subfields: id (2 bytes), length (2 bytes), data
+            size = struct.unpack('<H',extra[i+2:i+4])[0]
+            if extra[i:i+2] == 'BC': return struct.unpack('<H',extra[i+4:i+6])[0]+1
+            i += 4+size
+        sys.exit("Not a BGZF file: %s" % self.path)
+
+    def table(self):
+        """Return the position of each block in the file, and of its data once decompressed,
+           each followed by the total size. Read from the sidecar file if it is up to date."""
+        tpath = cache_path(self.path,'.glx')
+        stamp = Index(self.path).stamp()
+        try:
+            with open(tpath) as f:
+                data = json.load(f)
+            if data['version'] == self.version and data['stamp'] == stamp:
+                return data['blocks'],data['starts']
+        except (IOError,ValueError,KeyError):
+            pass
+        blocks,starts = [0],[0]
+        while True:
+            size = self.header(blocks[-1])
+            if size is None: break
+            self.file.seek(blocks[-1]+size-4)
+            blocks.append(blocks[-1]+size)
+            starts.append(starts[-1]+struct.unpack('<I',self.file.read(4))[0])
+        try:
+            with open(tpath,'w') as f:
+                json.dump({'version':self.version,'stamp':stamp,'blocks':blocks,'starts':starts},f)
+        except (IOError,OSError):
+            pass # keep it in memory only
+        return blocks,starts
+
+    def load(self,k):
+        """Decompress block number *k*. Return False if there is none."""
+        if k >= len(self.blocks)-1: return False
+        self.file.seek(self.blocks[k])
+        data = self.file.read(self.blocks[k+1]-self.blocks[k])
+        skip = 12 + struct.unpack('<H',data[10:12])[0] # header
+        self.block = zlib.decompress(data[skip:-8],-zlib.MAX_WBITS)
+        self.k = k
+        self.pos = 0
+        return True
+
+    def seek(self,offset,whence=0):
+        if whence == 1: offset += self.tell()
+        elif whence == 2: offset += self.starts[-1]
+        k = max(min(bisect.bisect_right(self.starts,offset),len(self.starts)-1)-1,0)
+        if k != self.k and not self.load(k): return # empty file
+        self.pos = offset - self.starts[k]
+
+    def tell(self):
+        return self.starts[self.k] + self.pos if self.k >= 0 else 0
+
+    def read(self,size=-1):
+        chunks = []
+        while size != 0:
+            if self.pos >= len(self.block):
+                if not self.load(self.k+1): break
+                continue
+            data = self.block[self.pos:self.pos+size] if size > 0 else self.block[self.pos:]
+            self.pos += len(data)
+            chunks.append(data)
+            if size > 0: size -= len(data)
+        return ''.join(chunks)
+
+    def readline(self):
+        chunks = []
+        while True:
+            if self.pos >= len(self.block):
+                if not self.load(self.k+1): break
+                continue
+            i = self.block.find('\n',self.pos)+1 or len(self.block)
+            chunks.append(self.block[self.pos:i])
+            self.pos = i
+            if chunks[-1].endswith('\n'): break
+        return ''.join(chunks)
+
+###############################################################################
+
+class BinaryTrack(object):
+    """Columnar binary copy of a bed/bedGraph file, read through a memory map.
+
+    For each chromosome, the start and end coordinates are stored as int32 (int64 if
+    needed), and either the scores as float32, or the names as a blob of '\n'-terminated
+    strings with the offset of each. Scores are stored as float32, or float64 if they
+    cannot be converted without loss. The columns are ctypes arrays pointing directly
+    into the memory map, so that nothing is parsed or copied except the window that is
+    read. It has the same interface as `Parser`; the *offset* of a stream is the index
+    of the next feature, counted over all chromosomes. If the ends of a chromosome are not
+    sorted, their running maximum is stored too, to find where a region starts by bisection.
+    The file is created by `build` (``gless --build-cache``) and saved as a sidecar file
+    like the `Index`, with extension *ext*. It is ignored if the track has changed since.
+    Its JSON header comes after the columns, so that they are written one chromosome at a
+    time; its size and position are at the beginning."""
+    magic = 'GLESSBIN'
+    version = 3
+    chunksize = 2**12 # number of features converted to tuples at once
+    typecodes = {'i':ctypes.c_int32, 'q':ctypes.c_int64, 'f':ctypes.c_float, 'd':ctypes.c_double}
+
+    def __init__(self,filename,ext='.glb'):
+        self.path = os.path.abspath(filename)
+        self.ext = ext
+        self.format = track_format(filename)
+        self.fields = ['chr','start','end','score' if self.format.lower()=='bedgraph' else 'name']
+        header,start = self.read_header(self.path,ext)
+        self.nfields = header['nfields']
+        self.chroms = [str(c['name']) for c in header['chroms']]
+        self.firsts = [] # index of the first feature of each chromosome
+        self.columns = [] # [{'start':array, 'end':array, 'score' or 'names':array}, ...]
+        self.sorted = [c['sorted'] for c in header['chroms']] # whether the ends are sorted too
+        with open(cache_path(self.path,ext),'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_COPY) # private: never written
+        nfeat = 0
+        for c in header['chroms']:
+            self.firsts.append(nfeat)
+            nfeat += c['n']
+            columns = {}
+            for name,(offset,type,size) in c['columns'].iteritems():
+                columns[name] = (self.typecodes[type]*size).from_buffer(self.mmap,start+offset)
+            if 'blob' in c: columns['blob'] = start+c['blob']
+            self.columns.append(columns)
+        self.feats = iter([]) # iterator over the current chunk of features
+        self.nfeats = 0       # number of features in the current chunk
+        self.base = 0         # index of the first feature of the current chunk
+    def __enter__(self):
+        return self
+    def __exit__(self,errtype,value,traceback):
+        pass
+    @property
+    def offset(self):
+        """Index of the next feature to read."""
+        return self.base + self.nfeats - self.feats.__length_hint__()
+
+    @classmethod
+    def read_header(cls,path,ext='.glb'):
+        """Return the header of the binary file of track *path* and the position of
+           the data in the file, or (None,None) if it is missing or outdated."""
+        try:
+            with open(cache_path(path,ext),'rb') as f:
+                if f.read(len(cls.magic)) != cls.magic: return None,None
+                size,pos = struct.unpack('<QQ',f.read(16))
+                start = f.tell()
+                f.seek(pos)
+                header = json.loads(f.read(size))
+            if header['version'] != cls.version or header['byteorder'] != sys.byteorder \
+               or header['stamp'] != Index(path).stamp():
+                return None,None
+        except (IOError,OSError,ValueError,KeyError,struct.error):
+            return None,None
+        return header,start
+
+    @classmethod
+    def exists(cls,path,ext='.glb'):
+        """Whether an up-to-date binary file exists for the track *path*."""
+        return cls.read_header(path,ext)[0] is not None
+
+    @classmethod
+    def build(cls,path):
+        """Parse the track file *path* once, and write its binary copy. Only one chromosome
+           is kept in memory at a time, so the file must be sorted by chromosome: if it
+           is not, no copy is made (see `sort_track`). Return whether it was made."""
+        parser = Parser(path)
+        with open_file(parser.path) as f:
+            nfields = len(f.readline().rstrip('\r\n').split('\t'))
+        density = parser.format.lower() == 'bedgraph' and nfields > 3
+        def chroms():
+            done = set()
+            with parser:
+                for chr,feats in itertools.groupby(parser.read(),operator.itemgetter(0)):
+                    if chr in done: raise ValueError(chr)
+                    done.add(chr)
+                    starts,ends = (array.array('l'),array.array('l'))
+                    others = array.array('d') if density else []
+                    for x in feats:
+                        starts.append(x[1])
+                        ends.append(x[2])
+                        others.append(x[3])
+                    c = OrderedDict([('start',starts),('end',ends)])
+                    if density: c['score'] = others
+                    elif nfields > 3: c['names'] = others
+                    yield chr,c
+        try:
+            cls.write(path,'.glb',nfields,chroms())
+        except ValueError, e:
+            print >>sys.stderr, ("No binary copy of %s: %s comes in several blocks. "
+                                 "Sort it first with `gless sort`." % (path,e))
+            return False
+        return True
+
+    @classmethod
+    def write(cls,path,ext,nfields,chroms,**info):
+        """Write the binary file *ext* of track *path* from the columns of each chromosome,
+           *chroms* = [(name, {'start':array, 'end':array, ...}), ...]. Coordinates are
+           stored as integers, 'names' as a blob of strings, and any other column as floats.
+           *info* is added to the header."""
+        header = {'version':cls.version, 'byteorder':sys.byteorder,
+                  'stamp':Index(path).stamp(), 'nfields':nfields, 'chroms':[]}
+        header.update(info)
+        bpath = cache_path(path,ext)
+        with open(bpath+'.tmp','wb') as f:
+            f.write(cls.magic + struct.pack('<QQ',0,0)) # size and position of the header
+            start = f.tell()
+            def add(string): # write a block of bytes, padded to a multiple of 8 bytes
+                pos = f.tell() - start
+                f.write(string + '\0' * (-len(string) % 8))
+                return pos
+            def integers(a):
+                return [add(a.tostring()),'i' if a.itemsize==4 else 'q',len(a)]
+            try:
+                for chr,columns in chroms:
+                    ends = columns['end']
+                    itype = 'i' if max(ends) < 2**31 else 'l' # 'l' is 64-bit on 64-bit systems
+                    c = {'name':chr, 'n':len(ends), 'columns':{},
+                         'sorted':all(itertools.imap(operator.le,ends[:-1],ends[1:]))}
+                    for name,a in columns.iteritems():
+                        if name in ('start','end'):
+                            c['columns'][name] = integers(array.array(itype,a))
+                        elif name == 'names':
+                            pos = array.array('l',[0])
+                            for x in a: pos.append(pos[-1]+len(x)+1)
+                            c['columns']['names'] = integers(pos)
+                            c['blob'] = add(''.join(x+'\n' for x in a))
+                        else:
+                            if array.array('f',a).tolist() == a.tolist():
+                                a = array.array('f',a)
+                            c['columns'][name] = [add(a.tostring()),a.typecode,len(a)]
+                    if not c['sorted']:
+                        maxend = array.array(itype,ends)
+                        for i in xrange(1,len(maxend)):
+                            if maxend[i] < maxend[i-1]: maxend[i] = maxend[i-1]
+                        c['columns']['maxend'] = integers(maxend)
+                    header['chroms'].append(c)
+            except BaseException:
+                f.close()
+                os.remove(bpath+'.tmp')
+                raise
+            header = json.dumps(header)
+            pos = f.tell()
+            f.write(header)
+            f.seek(len(cls.magic))
+            f.write(struct.pack('<QQ',len(header),pos))
+        os.rename(bpath+'.tmp',bpath)
+
+    def find(self,k,start):
+        """Return the index in chromosome number *k* of the first feature that ends
+           after *start*, like `Index.seek`: a long feature that starts well before is
+           found too, since the maximum of the ends so far is searched instead of them."""
+        c = self.columns[k]
+        return bisect.bisect_right(c.get('maxend',c['end']),start)
+
+    def window(self,k,i,j,chrom=True):
+        """Return the features *i* to *j* of chromosome number *k* as a list of tuples,
+           without the chromosome name if *chrom* is False."""
+        c = self.columns[k]
+        columns = [c['start'][i:j],c['end'][i:j]]
+        if 'score' in c:
+            columns.append(c['score'][i:j])
+            if 'min' in c: # zoom level of a `Pyramid`
+                columns.extend([c['min'][i:j],c['max'][i:j]])
+        elif 'names' in c:
+            pos = c['names']
+            columns.append(self.mmap[c['blob']+pos[i]:c['blob']+pos[j]].split('\n'))
+        else:
+            columns.append(itertools.repeat("00"))
+        if chrom:
+            columns.insert(0,itertools.repeat(self.chroms[k]))
+        return zip(*columns)
+
+    def batch(self,k,i,j):
+        """Return the features *i* to *j* of chromosome number *k* as a `Batch`, copying
+           the numbers directly from the memory map instead of making tuples."""
+        c = self.columns[k]
+        columns = []
+        for name in ('start','end','score','min','max'):
+            if name not in c: continue
+            a = c[name]
+            typecode = 'l' if name in ('start','end') else 'd'
+            size = ctypes.sizeof(a._type_)
+            try:
+                raw = array.array(a._type_._type_)
+                raw.fromstring(buffer(a)[i*size:j*size])
+            except ValueError: # no such array type, e.g. int64 where long is 32-bit
+                raw = a[i:j]
+            columns.append(raw if getattr(raw,'typecode',None) == typecode
+                           else array.array(typecode,raw))
+        if 'names' in c:
+            pos = c['names']
+            columns.append(self.mmap[c['blob']+pos[i]:c['blob']+pos[j]].split('\n')[:j-i])
+        elif 'score' not in c:
+            columns.append(['00']*(j-i))
+        return Batch(columns)
+
+    def read(self,fields=None,selection=None,offset=None):
+        """Same as `Parser.read`."""
+        if not self.chroms: return iter([])
+        if offset is None:
+            offset = 0
+            if selection:
+                if selection['chr'] not in self.chroms: return iter([])
+                k = self.chroms.index(selection['chr'])
+                i = self.find(k,selection.get('start',[0])[0])
+                if i == len(self.columns[k]['start']): return iter([]) # all end before it
+                offset = self.firsts[k] + i
+        self.feats = iter([])
+        self.nfeats = 0
+        self.base = offset
+        return itertools.chain.from_iterable(self.chunks(offset))
+
+    def chunks(self,offset):
+        """Yield iterators over successive chunks of features, starting at index *offset*."""
+        k = bisect.bisect_right(self.firsts,offset)-1
+        while k < len(self.chroms):
+            n = len(self.columns[k]['start'])
+            i = offset - self.firsts[k]
+            while i < n:
+                j = min(i+self.chunksize,n)
+                if profile: t = time.time()
+                feats = self.window(k,i,j)
+                if profile: profile.add('parse',time.time()-t)
+                self.base = self.firsts[k]+i
+                self.feats = iter(feats)
+                self.nfeats = len(feats)
+                yield self.feats
+                i = j
+            k += 1
+            if k < len(self.chroms): offset = self.firsts[k]
+
+class Pyramid(object):
+    """Zoom levels of a density track, to read wide windows (-b) without reading all features.
+
+    Level k summarizes the track in bins of *factor*^k times its mean feature length
+    (the base resolution). For each bin that is covered, it stores the extent covered, the
+    mean score (weighted by the length covered), and the min and max scores. Each level is
+    a `BinaryTrack` with the extra columns 'min' and 'max', saved as a sidecar file '.glz<k>'.
+    Levels are computed one from the other, until there are less than *minbins* bins.
+    Only the bins of one chromosome are kept in memory: all the levels of a chromosome
+    are computed at once, and kept in a temporary file per level until all are known."""
+    factor = 10
+    minbins = 1000
 
-    def save(self,content):
-        chrom = content[0][0][0]
-        self.content.setdefault(chrom,[]).append(content)
+    @classmethod
+    def levels(cls,path):
+        """Return [(binsize,ext),...] for the up-to-date levels of track *path*, finest first."""
+        levels = []
+        while True:
+            ext = '.glz%d' % (len(levels)+1)
+            header = BinaryTrack.read_header(path,ext)[0]
+            if header is None: return levels
+            levels.append((header['binsize'],ext))
+
+    @classmethod
+    def open(cls,path,bpp):
+        """Return the coarsest level of track *path* with bins of at most *bpp* bp,
+           as a `BinaryTrack`, or None if there is none."""
+        levels = [ext for binsize,ext in cls.levels(path) if binsize <= bpp]
+        if levels: return BinaryTrack(path,levels[-1])
+
+    @classmethod
+    def build(cls,path):
+        """Read the track file *path* once, and write all its levels. The file must be sorted
+           by chromosome: if it is not, no level is made (see `sort_track`)."""
+        parser = Parser(path)
+        with parser:
+            lengths = [x[2]-x[1] for x in itertools.islice(parser.read(),1000)]
+            if not lengths: return
+            binsize = cls.factor * max(1,sum(lengths)//len(lengths))
+            files = []    # a temporary file per level, with the columns of each chromosome
+            counts = []   # [{chrom: number of bins}, ...] per level, for those in the file
+            single = OrderedDict() # {chrom: columns of its last level, with a single bin}
+            try:
+                for chr,feats in itertools.groupby(parser.read(),operator.itemgetter(0)):
+                    if chr in single:
+                        print >>sys.stderr, ("No zoom levels for %s: %s comes in several blocks. "
+                                             "Sort it first with `gless sort`." % (path,chr))
+                        return
+                    # First level: split the features into bins
+                    bins = {} # {bin: [sum of score*length, length, min, max, start, end]}
+                    for _,start,end,score in feats:
+                        s = float(score)
+                        for b in xrange(start//binsize,max(start,end-1)//binsize+1):
+                            lo = max(start,b*binsize)
+                            hi = min(end,(b+1)*binsize)
+                            x = bins.get(b)
+                            if x is None:
+                                bins[b] = [s*(hi-lo),hi-lo,s,s,lo,hi]
+                            else:
+                                cls.merge(x,[s*(hi-lo),hi-lo,s,s,lo,hi])
+                    # Next levels: merge the bins by groups of *factor*, until one is left
+                    k = 0
+                    while True:
+                        if k == len(files):
+                            files.append(tempfile.TemporaryFile())
+                            counts.append({})
+                        columns = cls.columns(bins)
+                        cPickle.dump((chr,columns),files[k],cPickle.HIGHEST_PROTOCOL)
+                        counts[k][chr] = len(bins)
+                        if len(bins) <= 1: break
+                        bins = cls.parents(bins)
+                        k += 1
+                    single[chr] = columns
+                k = 0
+                nbins = None
+                while True:
+                    cls.write(path,'.glz%d' % (k+1),binsize*cls.factor**k,files,counts,single,k)
+                    total = sum((counts[k] if k < len(counts) else {}).get(c,1) for c in single)
+                    if total < cls.minbins or total == nbins: break
+                    nbins = total
+                    k += 1
+            finally:
+                for f in files: f.close()
+
+    @classmethod
+    def parents(cls,bins):
+        """Return the bins of the next level, merging *bins* by groups of *factor*."""
+        parents = {}
+        for b,x in bins.iteritems():
+            y = parents.get(b//cls.factor)
+            if y is None: parents[b//cls.factor] = x
+            else: cls.merge(y,x)
+        return parents
+
+    @classmethod
+    def merge(cls,x,y):
+        """Add the bin *y* to the bin *x*."""
+        x[0] += y[0]
+        x[1] += y[1]
+        if y[2] < x[2]: x[2] = y[2]
+        if y[3] > x[3]: x[3] = y[3]
+        if y[4] < x[4]: x[4] = y[4]
+        if y[5] > x[5]: x[5] = y[5]
+
+    @classmethod
+    def columns(cls,bins):
+        """Return the columns of the *bins* of one chromosome,
+           {bin: [sum, length, min, max, start, end]}."""
+        bins = [bins[b] for b in sorted(bins)]
+        return OrderedDict([('start',array.array('l',[x[4] for x in bins])),
+            ('end',array.array('l',[x[5] for x in bins])),
+            ('score',array.array('d',[x[0]/x[1] if x[1] else x[2] for x in bins])),
+            ('min',array.array('d',[x[2] for x in bins])),
+            ('max',array.array('d',[x[3] for x in bins]))])
+
+    @classmethod
+    def write(cls,path,ext,binsize,files,counts,single,k):
+        """Save level number *k* (from 0) from the temporary *files* made by `build`: the
+           chromosomes that had only one bin left before this level keep it."""
+        def chroms():
+            f = files[k] if k < len(files) else None
+            if f: f.seek(0)
+            for chr in single:
+                if f and chr in counts[k]: yield cPickle.load(f)
+                else: yield chr,single[chr]
+        BinaryTrack.write(path,ext,4,chroms(),binsize=binsize)
+
+class Stats(object):
+    """Summary of the scores of a bedGraph track, to scale its vertical axis once for all
+    pages instead of on the scores of each window.
+
+    For each chromosome it records the number of features, the min, max and sum of their
+    scores, and a sketch of their distribution from which approximate quantiles are read:
+    like DDSketch, scores are counted in buckets of geometrically increasing width, *gamma*
+    times wider each (the positive score x goes to bucket ceil(log_gamma(x))), so that any
+    quantile is found with a relative error below *accuracy*. Negative scores are counted
+    the same way on their absolute value, and zeros apart. Sketches of several chromosomes
+    are merged by adding their counts. It is computed in one pass over the track the first
+    time it is needed, and saved as JSON in a sidecar file '.gls' until the track changes."""
+    version = 1
+    accuracy = 0.01
+    gamma = (1+accuracy) / (1-accuracy)
+    chunksize = 2**16 # number of scores sorted at once
+
+    def __init__(self,path):
+        self.path = os.path.abspath(path)
+        self.spath = cache_path(self.path,'.gls')
+        self.chroms = OrderedDict() # {chrom: {'n','min','max','sum','zero','pos','neg'}},
+                                    # 'pos' and 'neg' being {bucket: count}
 
     def load(self):
-        return self.content[-1]
+        """Read the statistics from disk, or compute them if they are missing or outdated."""
+        try:
+            with open(self.spath) as f:
+                header = json.load(f,object_pairs_hook=OrderedDict)
+            if header['version'] == self.version and header['stamp'] == Index(self.path).stamp():
+                self.chroms = header['chroms']
+                for c in self.chroms.itervalues():
+                    for sign in ('pos','neg'):
+                        c[sign] = dict((int(k),n) for k,n in c[sign].iteritems())
+                return self
+        except (IOError,OSError,ValueError,KeyError):
+            pass
+        self.build()
+        try:
+            with open(self.spath,'w') as f:
+                json.dump({'version':self.version, 'stamp':Index(self.path).stamp(),
+                           'chroms':self.chroms},f)
+        except (IOError,OSError):
+            pass # keep it in memory only
+        return self
+
+    def build(self):
+        """Read the whole track once. The scores are sorted by chunks, so that each bucket
+           is counted with two binary searches instead of a logarithm per score."""
+        self.chroms = OrderedDict()
+        score = operator.itemgetter(3)
+        with Parser(self.path) as parser:
+            stream = parser.read(fields=['chr','start','end','score'])
+            for chrom,feats in itertools.groupby(stream,operator.itemgetter(0)):
+                while True:
+                    scores = sorted(itertools.imap(score,itertools.islice(feats,self.chunksize)))
+                    if not scores or not isinstance(scores[0],float): break # no scores
+                    self.add(chrom,scores)
+
+    def add(self,chrom,scores):
+        """Count the *scores* (sorted) of features of *chrom*."""
+        c = self.chroms.get(chrom)
+        if c is None:
+            c = self.chroms[chrom] = {'n':0, 'min':scores[0], 'max':scores[-1], 'sum':0.,
+                                      'zero':0, 'pos':{}, 'neg':{}}
+        c['n'] += len(scores)
+        c['min'] = min(c['min'],scores[0])
+        c['max'] = max(c['max'],scores[-1])
+        c['sum'] += sum(scores)
+        i = bisect.bisect_left(scores,0.)
+        j = bisect.bisect_right(scores,0.,i)
+        c['zero'] += j-i
+        self.count(c['pos'],scores[j:])
+        self.count(c['neg'],[-x for x in reversed(scores[:i])])
+
+    def count(self,buckets,values):
+        """Add the positive *values* (sorted) to *buckets*."""
+        if not values: return
+        lg = math.log(self.gamma)
+        k = int(math.ceil(math.log(values[0])/lg))
+        last = int(math.ceil(math.log(values[-1])/lg))
+        i = 0
+        while i < len(values):
+            j = bisect.bisect_right(values,self.gamma**k,i) if k < last else len(values)
+            if j > i: buckets[k] = buckets.get(k,0) + j-i
+            i = j
+            k += 1
+
+    def quantile(self,q,chroms=None):
+        """Return the approximate *q*-quantile (0 <= q <= 1) of the scores of *chroms*
+           (all by default), or None if there are none."""
+        cs = [self.chroms[c] for c in (chroms or self.chroms) if c in self.chroms]
+        n = sum(c['n'] for c in cs)
+        if not n: return None
+        lo = min(c['min'] for c in cs)
+        hi = max(c['max'] for c in cs)
+        pos,neg = (Counter(),Counter())
+        for c in cs:
+            pos.update(c['pos'])
+            neg.update(c['neg'])
+        mid = 2 / (self.gamma+1) # bucket k stands for mid*gamma**k, the relative error is the same on both sides
+        buckets = [(-mid*self.gamma**k,m) for k,m in sorted(neg.iteritems(),reverse=True)] \
+                + [(0.,sum(c['zero'] for c in cs))] \
+                + [(mid*self.gamma**k,m) for k,m in sorted(pos.iteritems())]
+        rank = q*(n-1)
+        seen = 0
+        for value,m in buckets:
+            seen += m
+            if seen > rank: return min(max(value,lo),hi)
+        return hi
+
+def open_track(filename,build=False):
+    """Return a `BinaryTrack` if an up-to-date binary copy of *filename* exists
+       (or after creating it, if *build* is True), else a `track`."""
+    if track_format(filename).lower() in ['bed','bedgraph']:
+        if build and not BinaryTrack.exists(filename):
+            BinaryTrack.build(filename)
+        if BinaryTrack.exists(filename):
+            return BinaryTrack(filename)
+        if filename.endswith('.gz'):
+            return Parser(filename)
+    return track(filename)
+
+def spool(stream):
+    """Copy *stream* (the standard input) to a temporary file as it comes, in a background
+       thread, so that it can be read as a growing track in follow mode. Return the path
+       of the file, named after the format guessed from the first line. Its directory is
+       removed at exit, with the sidecar files written next to it."""
+    fd = stream.fileno()
+    data = ''
+    while '\n' not in data:
+        chunk = os.read(fd,Parser.blocksize)
+        if not chunk: break
+        data += chunk
+    line0 = data.split('\n',1)[0].split('\t')
+    ext = '.bed'
+    if line0[0].startswith('track'):
+        if 'bedGraph' in line0[0]: ext = '.bedGraph'
+    elif len(line0) > 3:
+        try: float(line0[3])
+        except ValueError: pass
+        else: ext = '.bedGraph'
+    tmpdir = tempfile.mkdtemp(prefix='gless')
+    atexit.register(shutil.rmtree,tmpdir,True)
+    path = os.path.join(tmpdir,'stdin'+ext)
+    f = open(path,'wb')
+    f.write(data)
+    f.flush()
+    def copy():
+        data = os.read(fd,Parser.blocksize)
+        while data:
+            f.write(data)
+            f.flush()
+            data = os.read(fd,Parser.blocksize)
+        f.close()
+    thread = threading.Thread(target=copy)
+    thread.daemon = True
+    thread.start()
+    return path
 
 ###############################################################################
 
+class Profile(object):
+    """Time spent in each stage of the pages, and numbers of features and canvas items,
+    when gless is run with --profile (or the environment variable GLESS_PROFILE is set).
+
+    The code adds to the counters of its thread with `add` (as `if profile: ...`, so that
+    nothing is done otherwise), and they are attached to a page with `done`, once by the
+    thread that reads it and once by the one that draws it. Stages are 'read' (including
+    'parse', the rest being the merge of the tracks), 'selection' and 'draw'. At exit,
+    `save` writes all pages as JSON in <prefix>.json, and the cProfile statistics of the
+    main thread in <prefix>.prof."""
+
+    def __init__(self,prefix):
+        self.prefix = prefix
+        self.counters = {}           # {thread id: Counter of the page in progress}
+        self.pages = OrderedDict()   # {(chrom,ntimes): Counter}
+        self.trace = []              # [(time,(chrom,ntimes),Counter),...] each time `done` is called
+        self.t0 = time.time()
+        self.cprofile = cProfile.Profile()
+        self.cprofile.enable()
+
+    def add(self,name,value):
+        """Add *value* (seconds or a count) to *name* for the current thread."""
+        ident = threading.current_thread().ident
+        self.counters.setdefault(ident,Counter())[name] += value
+
+    def done(self,key):
+        """Attach what the current thread counted to page *key* = (chrom,ntimes)."""
+        counter = self.counters.pop(threading.current_thread().ident,Counter())
+        self.pages.setdefault(key,Counter()).update(counter)
+        self.trace.append((time.time()-self.t0,key,counter))
+
+    def status(self,key):
+        """Text summary of page *key*."""
+        c = self.pages.get(key,Counter())
+        return "read %.0f ms\n(parse %.0f ms)\ndraw %.0f ms\n%d feats\n%d new items" \
+               % (1000*c['read'],1000*c['parse'],1000*c['draw'],c['features drawn'],c['items created'])
+
+    def save(self):
+        self.cprofile.disable()
+        self.cprofile.dump_stats(self.prefix+'.prof')
+        pages = []
+        for (chrom,ntimes),c in self.pages.iteritems():
+            page = {'chrom':chrom, 'ntimes':ntimes, 'merge':max(c['read']-c['parse'],0)}
+            page.update(c)
+            pages.append(page)
+        trace = [{'time':t, 'chrom':chrom, 'ntimes':ntimes, 'counters':c}
+                 for t,(chrom,ntimes),c in self.trace]
+        with open(self.prefix+'.json','w') as f:
+            json.dump({'pages':pages, 'trace':trace},f,indent=1)
+        print >>sys.stderr, "Profile saved in %s.json and %s.prof" % (self.prefix,self.prefix)
+
+profile = None # a `Profile`, if enabled
+
+###############################################################################
+
+class Memory(object):
+    """Cache of the pages already read, to go back without reading the files again.
+
+    Pages are identified by a key (chromosome, ntimes), and listed in *history* in the
+    order they were first read. The content of the least recently displayed pages is
+    dropped when the cache exceeds *limit* megabytes; they can be read again from
+    the checkpoints of the reader (see `Reader.read_page`)."""
+    feat_size = 60 # approximate memory taken by a cached feature in a `Batch`, in bytes
+
+    def __init__(self,limit=100):
+        self.limit = limit * 2**20 / self.feat_size # max number of cached features
+        self.size = 0                 # number of cached features
+        self.content = OrderedDict()  # {key: content}, least recently used first
+        self.bounds = {}              # {key: (minpos,maxpos)}
+        self.history = []             # [key,...] in reading order
+        self.pos = -1                 # index in *history* of the displayed page
+
+    def save(self,key,content):
+        """Add a new page."""
+        self.bounds[key] = None
+        self.history.append(key)
+        self.pos = len(self.history)-1
+        self.cache(key,content)
+
+    def cache(self,key,content):
+        """Keep *content* in memory, dropping older pages if necessary."""
+        if key in self.content:
+            self.size -= sum(len(t) for t in self.content.pop(key))
+        self.content[key] = content
+        self.size += sum(len(t) for t in content)
+        while self.size > self.limit and len(self.content) > 1:
+            _,old = self.content.popitem(last=False)
+            self.size -= sum(len(t) for t in old)
+
+    def load(self,key):
+        """Return the content of page *key*, or None if it is not in memory anymore."""
+        content = self.content.pop(key,None)
+        if content is not None:
+            self.content[key] = content # now the most recently used
+        return content
+
+    def key(self):
+        return self.history[self.pos]
+
+    def at_head(self):
+        """Whether the displayed page is the last one read."""
+        return self.pos == len(self.history)-1
+
+class Prefetcher(object):
+    """Read the next pages of *stream* on a background thread while a page is displayed.
+
+    At most *depth* pages are read in advance, as (key, content, chrom_change). The
+    thread moves the reader to the next page like `Gless.fast_forward` did, and stops
+    after the last page of a chromosome, so that the next one is only read when the
+    user gets there. It must be stopped (`stop`) before the reader is used by another
+    thread; the pages already read are kept, and reading resumes on the next `get`."""
+
+    def __init__(self,reader,stream,depth=2):
+        self.reader = reader
+        self.stream = stream
+        self.depth = depth
+        self.pages = deque()   # pages read in advance; None marks the end of the files
+        self.lock = threading.Condition()
+        self.thread = None
+        self.running = False   # whether the thread is reading or waiting for space
+        self.stopped = False   # asks the thread to stop before reading the next page
+        self.error = None      # exception raised in the thread, raised again by `get`
+
+    def start(self):
+        """Start the thread unless it is already running or nothing is left to read."""
+        with self.lock:
+            if self.running or self.error or (self.pages and self.pages[-1] is None):
+                return
+            self.running = True
+            self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the thread after the page being read, if any, and wait for it."""
+        with self.lock:
+            self.stopped = True
+            self.lock.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            with self.lock:
+                while len(self.pages) >= self.depth and not self.stopped:
+                    self.lock.wait()
+                if self.stopped:
+                    self.running = False
+                    return
+            try: page = self.read()
+            except BaseException:
+                page = None
+                self.error = sys.exc_info()
+            with self.lock:
+                self.pages.append(page)
+                if page is not None and page[2] and self.reader.chrom is None:
+                    self.pages.append(None) # the last chromosome ended with the files
+                if page is None or page[2]: # end of the files, or of a chromosome
+                    self.running = False
+                self.lock.notify_all()
+                if not self.running: return
+
+    def read(self):
+        """Read one page and move the reader to the next one."""
+        reader = self.reader
+        if profile: t = time.time()
+        try: content = self.stream.next()
+        except StopIteration: return None
+        page = ((reader.chrom,reader.ntimes),content,reader.chrom_change)
+        if profile:
+            profile.add('read',time.time()-t)
+            profile.add('features read',sum(len(x) for x in content))
+            profile.done(page[0])
+        reader.next_page()
+        return page
+
+    def at_end(self):
+        """Whether the end of the files was reached, and all pages before were taken."""
+        with self.lock:
+            return bool(self.pages) and self.pages[0] is None
+
+    def get(self):
+        """Return the next page, waiting for it if it is not read yet, or None at the end.
+           Start reading the following ones in the background."""
+        if not self.pages: self.start()
+        with self.lock:
+            while not self.pages:
+                self.lock.wait()
+            page = self.pages[0]
+            if page is not None: self.pages.popleft()
+            self.lock.notify_all()
+        if self.error:
+            raise self.error[0],self.error[1],self.error[2]
+        if page is not None and not page[2]:
+            self.start()
+        return page
+
+###############################################################################
+
+class Batch(object):
+    """The features of one track in a page, stored by column: arrays of integers for the
+    starts and ends, of floats for the scores (and the min and max of the bins of a zoom
+    level), and a list for the names. It behaves as a read-only list of tuples
+    (start,end,other,...), but takes a few bytes per feature instead of a tuple each,
+    both in `Memory` and when sent back by the processes of `Reader.workers`. The
+    buffer of `Reader.read_nfeat` keeps the features waiting to be shown the same way."""
+
+    def __init__(self,columns=()):
+        self.columns = list(columns)
+
+    @staticmethod
+    def compact(column):
+        """Return *column* as an array if it contains only numbers, else as a list."""
+        if isinstance(column,array.array): return column
+        column = list(column)
+        if column and isinstance(column[0],(int,long,float)):
+            try: return array.array('d' if isinstance(column[0],float) else 'l',column)
+            except (TypeError,OverflowError): pass # not all of the same type
+        return column
+
+    def extend(self,feats):
+        """Append *feats*, a list of tuples or another `Batch`, and return self."""
+        columns = feats.columns if isinstance(feats,Batch) else zip(*feats)
+        if not self.columns:
+            self.columns = [self.compact(c) for c in columns]
+        elif columns:
+            for k,(a,c) in enumerate(zip(self.columns,columns)):
+                try:
+                    if isinstance(a,list) or getattr(c,'typecode',None) == a.typecode: a.extend(c)
+                    else: a.extend(array.array(a.typecode,c))
+                except (TypeError,OverflowError): # e.g. floats after integers
+                    self.columns[k] = self.compact(list(a)+list(c))
+        return self
+
+    def append(self,x):
+        """Append the tuple *x* as a new row, and return its index. The rows already
+           there are never moved, so that their indices stay valid."""
+        if not self.columns:
+            self.columns = [self.compact([v]) for v in x]
+            return 0
+        for k,a in enumerate(self.columns):
+            try: a.append(x[k])
+            except (TypeError,OverflowError): # e.g. a float after integers
+                self.columns[k] = self.compact(list(a)+[x[k]])
+        return len(self.columns[0])-1
+
+    def rows(self,n):
+        """Iterate over the first *n* columns together, with None for those missing, e.g.
+           `for start,end,score,smin,smax in batch.rows(5)`. Unpacked this way, the rows
+           are read without making a tuple for each."""
+        if not self.columns: return iter([])
+        return itertools.izip(*self.columns[:n]+[itertools.repeat(None)]*(n-len(self.columns)))
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+    def __iter__(self):
+        return itertools.izip(*self.columns)
+    def __getitem__(self,i):
+        if isinstance(i,slice): return Batch(c[i] for c in self.columns)
+        if not self.columns: raise IndexError(i)
+        return tuple(c[i] for c in self.columns)
+    def __eq__(self,other):
+        return isinstance(other,(Batch,list)) and list(self) == list(other)
+    def __ne__(self,other):
+        return not self == other
+    def __repr__(self):
+        return repr(list(self))
+
+empty_window = Batch([array.array('l',[0]),array.array('l',[0]),['00']]) # marks a window without features
+
+def read_sorted(t,fields,maxpos):
+    """If the features of the `BinaryTrack` *t* are sorted by end position on this
+       chromosome, return at once all the next ones that end before *maxpos*, found
+       by binary search, as a `Batch`, and a new stream starting after them.
+       Else return ([],None)."""
+    offset = t.offset
+    k = bisect.bisect_right(t.firsts,offset-1)-1 # chromosome of the last feature read
+    if not t.sorted[k]: return [],None
+    i = offset - t.firsts[k]
+    j = bisect.bisect_right(t.columns[k]['end'],maxpos,i)
+    if j == i: return [],None
+    return t.batch(k,i,j), t.read(fields=fields,offset=t.firsts[k]+j)
+
+def read_window(t,stream,fields,x,chrom,maxpos):
+    """Read the features of track *t* on *chrom* that end before *maxpos*, from *x* (the last
+       feature read from *stream*). A feature that goes beyond is cut at *maxpos*, and its
+       other part kept for the next window. Return the features without the chromosome name
+       as a `Batch`, the next feature (or the last one), whether *stream* has ended, and the stream."""
+    batch = Batch()
+    feats = []
+    binary = isinstance(t,BinaryTrack)
+    while x[0] == chrom and x[2] <= maxpos:
+        feats.append(x[1:])
+        if binary:
+            more,moved = read_sorted(t,fields,maxpos)
+            if moved:
+                batch.extend(feats).extend(more)
+                feats = []
+                stream = moved
+        try: x = stream.next()
+        except StopIteration: return batch.extend(feats),x,True,stream
+    if x[0] == chrom and x[2] > maxpos and x[1] < maxpos:
+        feats.append((x[1],maxpos)+x[3:])
+        x = (x[0],maxpos)+x[2:]
+    return batch.extend(feats),x,False,stream
+
+_opened = {} # tracks opened by a process of `Reader.workers`, {(path,ext): [track,stream]}
+
+def read_job(job):
+    """Run `read_window` in a process of `Reader.workers`. *job* is
+       (path,ext,fields,offset,x,chrom,maxpos): the track is `BinaryTrack(path,ext)`, or
+       a `Parser` if *ext* is None, read from *offset*: the stream of the previous job
+       on this track is reused if it stopped there. The features are returned as a `Batch`,
+       with the offset of the stream after them."""
+    path,ext,fields,offset,x,chrom,maxpos = job
+    try:
+        opened = _opened.get((path,ext))
+        if opened is None:
+            t = Parser(path) if ext is None else BinaryTrack(path,ext)
+            opened = _opened[(path,ext)] = [t,None]
+        t,stream = opened
+        if stream is None or t.offset != offset:
+            stream = t.read(fields=fields,offset=offset)
+        feats,x,end,opened[1] = read_window(t,stream,fields,x,chrom,maxpos)
+    except SystemExit, e: # would kill the process and block the reader
+        return e.code
+    return feats,x,end,t.offset
+
 class Reader(object):
-    def __init__(self,trackList,nfeat,nbp,sel,types):
-        self.tracks = [track(t) for t in trackList]
-        self.available_streams = range(len(trackList))
+    entry_size = 250        # approximate memory taken by a buffered feature, in bytes
+    checkpoint_size = 1000  # approximate memory taken by a checkpoint besides its buffer
+
+    def __init__(self,tracks,nfeat,nbp,sel,types,workers=(),memory=25):
+        self.tracks = tracks
+        self.workers = workers # processes reading the windows of the tracks in parallel
+        # the tracks that the workers can open: {track number: (path,ext)}
+        self.jobs = dict((n,(t.path,getattr(t,'ext',None))) for n,t in enumerate(tracks)
+                         if isinstance(t,(Parser,BinaryTrack)))
+        self.available_streams = range(len(tracks))
+        self.tocs = {}     # {track number: {chrom: offset of its first feature} or None}
+        self.disagree = False # whether the tracks have their chromosomes in different orders
+        self.order = None  # all chromosomes in the order they are shown, see next_chromosome()
+        self.ranks = {}    # {chrom: index in *self.order*}
+        self.aligned = None # last chromosome on which the tracks were aligned, see align()
+        self.shown = {}    # {chrom: number of chromosomes shown before it}
+        self.nshown = 0    # number of chromosomes shown so far: those of *self.shown* below it
         self.sel = sel
         self.types = types
-        self.temp = []
-        self.chrom = self.init_chr()
+        self.temp = []     # -n: heap of the buffered entries (end,seq,n,row), see push();
+                           # -b: the next feature of each track
+        self.bufs = [Batch() for _ in tracks] # -n: the buffered features of each track, by row
+        self.bases = [0 for _ in tracks] # -n: number of the first row of each buffer
+        self.epoch = 0     # number of times the entries were numbered again, see compact()
+        self.rest = []     # buffered features of the other chromosomes, in reading order
+        self.clips = {}    # {seq: start} of the buffered features already partly shown
+        self.seq = 0       # number given to the next feature entering the buffer
+        self.first = 0     # seq of the first feature read during the current page
+        self.bufchrom = None # chromosome of the features in the heap *self.temp*
         self.chrom_change = False
-        self.next_chrom = self.chrom
         self.ntimes = 1
+        self.checkpoints = {} # {(chrom,ntimes): state of the reader at the beginning of the page}
+        self.history = []     # [(chrom,ntimes),...] of the pages read, in reading order
+        self.npages = {}      # {(chrom,ntimes): index in *self.history*}
+        self.limit = memory * 2**20 # max memory taken by the checkpoints, in bytes
+        self.size = 0         # memory taken by the checkpoints, see `weight`
+        self.replaying = False # whether `read_page` is reading pages again
         if nbp:
             self.nbp = nbp
             self.nfeat = None
         elif nfeat:
             self.nfeat = nfeat
             self.nbp = None
+        self.fields = [self.get_fields(n) for n in range(len(tracks))]
+        self.streams = self.open()
+        self.chrom = self.init_chr()
+        self.next_chrom = self.chrom
+        self.go_to_selection()
+        if self.sel: self.aligned = self.chrom # the streams start at the selection
+        if self.sel and len(self.available_streams) < len(self.tracks):
+            self.disagree = True # some tracks do not have it: they are moved later, see align()
+        if self.nfeat: self.fill()
 
-    def init_chr(self):
-        """Find the initial chromosome name."""
-        for t in self.tracks:
-            try: return t.read().next()[t.fields.index('chr')]
-            except StopIteration: continue
+    def get_fields(self,n):
+        """Return the fields to read from track number *n*."""
+        t = self.tracks[n]
+        if all(f in t.fields for f in ["chr","start","end"]):
+            _f = ["chr","start","end"]
+            if self.types[n]=='intervals' and "name" in t.fields:
+                _f.append("name")
+            elif self.types[n]=='density' and "score" in t.fields:
+                _f.append("score")
+        else:
+            _f = t.fields[:4]
+        return _f
 
-    def read(self):
-        """Yield a list of lists [[(1,2,n),(3,4,n)], [(1,3,n),(5,6,n)]] with either the *self.nfeat*
-           next items, or all next items within an *self.nbp* window. `n` is a name or a score."""
+    def open(self):
+        """Return one stream per track, starting at the selected region if possible."""
         streams = []
         for n,t in enumerate(self.tracks):
-            if all(f in t.fields for f in ["chr","start","end"]):
-                _f = ["chr","start","end"]
-                if self.types[n]=='intervals' and "name" in t.fields:
-                    _f.append("name")
-                elif self.types[n]=='density' and "score" in t.fields:
-                    _f.append("score")
+            if isinstance(t,(Parser,BinaryTrack)) and self.sel:
+                streams.append(t.read(fields=self.fields[n],selection=self.sel))
             else:
-                _f = t.fields[:4]
-            streams.append(t.read(fields=_f))
-        self.go_to_selection(streams)
+                streams.append(t.read(fields=self.fields[n]))
+        return streams
+
+    def init_chr(self):
+        """Read the first feature of each stream, and find the initial chromosome name."""
+        self.temp = []
+        for n,stream in enumerate(self.streams):
+            try: self.temp.append(stream.next())
+            except StopIteration: # empty, or the selected chromosome is not in this file
+                self.temp.append(None)
+                self.available_streams.remove(n)
+        for x in self.temp:
+            if x is not None: return x[0]
+
+    def read(self):
+        """Return a generator that yields a `Batch` per track, like [[(1,2,n),(3,4,n)], [(1,3,n),(5,6,n)]],
+           with either the *self.nfeat* next items, or all next items within an *self.nbp* window.
+           `n` is a name or a score."""
         if self.nfeat:
-            content = self.read_nfeat(streams)
+            return self.read_nfeat()
         elif self.nbp:
-            content = self.read_nbp(streams)
+            return self.read_nbp()
+
+    def checkpoint(self):
+        """Return the state of the reader between two pages: the file offset of each stream,
+           a copy of the buffer, and the position. Return None if some track cannot seek."""
+        offsets = [getattr(t,'offset',None) for t in self.tracks]
+        if None in offsets: return None
+        return {'offsets': offsets,
+                'temp': list(self.temp),
+                'rest': list(self.rest),
+                'bufs': list(self.bufs), # shared: rows are only appended to them
+                'bases': list(self.bases),
+                'epoch': self.epoch,
+                'clips': dict(self.clips),
+                'seq': self.seq,
+                'first': self.first,
+                'bufchrom': self.bufchrom,
+                'available_streams': list(self.available_streams),
+                'chrom': self.chrom,
+                'aligned': self.aligned,
+                'nshown': self.nshown,
+                'ntimes': self.ntimes,
+                'chrom_change': self.chrom_change,
+                'next_chrom': self.next_chrom}
+
+    def seek(self,checkpoint):
+        """Put the reader back in the state of *checkpoint*, moving each stream
+           to its saved offset in the file instead of reading it again."""
+        self.streams = [t.read(fields=self.fields[n],offset=checkpoint['offsets'][n])
+                        for n,t in enumerate(self.tracks)]
+        self.temp = list(checkpoint['temp'])
+        self.rest = list(checkpoint['rest'])
+        self.bufs = list(checkpoint['bufs'])
+        self.bases = list(checkpoint['bases'])
+        self.epoch = checkpoint['epoch']
+        self.clips = dict(checkpoint['clips'])
+        self.seq = checkpoint['seq']
+        self.first = checkpoint['first']
+        self.bufchrom = checkpoint['bufchrom']
+        if self.nfeat: self.queue()
+        self.available_streams = list(checkpoint['available_streams'])
+        self.chrom = checkpoint['chrom']
+        self.aligned = checkpoint['aligned']
+        self.nshown = checkpoint['nshown']
+        self.ntimes = checkpoint['ntimes']
+        self.chrom_change = checkpoint['chrom_change']
+        self.next_chrom = checkpoint['next_chrom']
+
+    def resume(self):
+        """After `seek`, give the tracks that had ended their next features, if their
+           files have grown since (follow mode). Their tables of contents are read again:
+           the indexes only read the lines added (see `Index.load`)."""
+        self.tocs = {}
+        self.order = None
+        for n,stream in enumerate(self.streams):
+            if n in self.available_streams: continue
+            try: x = self.rejoin(n,stream.next())
+            except StopIteration: continue
+            stream = self.streams[n]
+            bisect.insort(self.available_streams,n)
+            if self.nbp:
+                self.temp[n] = x
+                continue
+            # as many as `fill` would have kept in the buffer
+            nbuf = sum(1 for e in itertools.chain(self.temp,self.rest) if e[2] == n)
+            for x in itertools.chain([x],itertools.islice(stream,max(self.nfeat-nbuf,0))):
+                entry = self.push(x,n)
+                if entry:
+                    heapq.heappush(self.temp,entry)
+                    self.queues[n].append(entry)
+
+    def rejoin(self,n,x):
+        """Return the next feature of track *n* after *x*, the first one read after it grew,
+           once moved to the current position: if *x* is on a chromosome already shown and
+           the track has the current one, it goes to it like in `align`, and skips the
+           features of the previous pages. Raise StopIteration if none is left."""
+        toc = self.toc(n)
+        if x[0] == self.chrom or not self.was_shown(x[0]) or not toc or self.chrom not in toc:
+            return x
+        if self.nbp:
+            pos = (self.ntimes-1)*self.nbp + (self.sel.get('start',[0])[0] if self.sel else 0)
+        else:
+            pos = self.temp[0][0] if self.temp else 0
+        self.streams[n] = self.tracks[n].read(fields=self.fields[n],offset=toc[self.chrom])
+        x = self.streams[n].next()
+        while x[0] == self.chrom and x[2] <= pos:
+            x = self.streams[n].next()
+        if self.nbp and x[0] == self.chrom and x[1] < pos:
+            x = (x[0],pos)+x[2:]
+        return x
+
+    def toc(self,n):
+        """Return the table of contents of track *n*, {chrom: offset of its first feature},
+           or None if it cannot seek. For a `Parser`, it comes from its `Index`."""
+        if n not in self.tocs:
+            t = self.tracks[n]
+            if isinstance(t,BinaryTrack):
+                self.tocs[n] = dict(zip(t.chroms,t.firsts))
+            elif isinstance(t,Parser):
+                self.tocs[n] = dict((str(c),x[2]) for c,x in Index(t.path).load(t.follow).chroms.iteritems())
+            else:
+                self.tocs[n] = None
+        return self.tocs[n]
+
+    def next_chromosome(self,heads):
+        """Return the chromosome to show after the current one, or None if it was the last.
+           *heads* are {track number: chromosome} of the next feature of the streams left.
+           As long as the tracks agree, it is the one they all reached. Else it is the next
+           one that was not shown yet in the order of the reference (the first track),
+           followed by the chromosomes that are only in the other tracks, as listed in
+           their tables of contents, since the tracks are moved to each chromosome in turn
+           (see `align`). The chromosomes that the tracks without one reached are added at
+           the end of the order as they come."""
+        if not self.disagree:
+            chroms = set(heads.itervalues())
+            if not chroms: return None
+            if len(chroms) == 1 and not self.was_shown(heads.values()[0]): return chroms.pop()
+            self.disagree = True
+        seen = [c for n,c in sorted(heads.iteritems()) if not self.toc(n)]
+        if self.order is None:
+            self.order = []
+            self.ranks = {}
+            for n in range(len(self.tracks)):
+                toc = self.toc(n) or {}
+                for c in sorted(toc,key=toc.get):
+                    if c not in self.ranks:
+                        self.ranks[c] = len(self.order)
+                        self.order.append(c)
+        for c in itertools.chain([self.chrom],seen):
+            if c not in self.ranks:
+                self.ranks[c] = len(self.order)
+                self.order.append(c)
+        for c in itertools.islice(self.order,self.ranks[self.chrom]+1,None):
+            if not self.was_shown(c): return c
+
+    def was_shown(self,chrom):
+        """Whether *chrom* was shown before the current position."""
+        return self.shown.get(chrom,self.nshown) < self.nshown
+
+    def set_shown(self,chrom):
+        """Record that *chrom* is being shown, so that it is not shown again."""
+        if not self.was_shown(chrom):
+            self.shown[chrom] = self.nshown
+            self.nshown += 1
+
+    def align(self):
+        """When the chromosome changes, move the tracks that are not on it to its first
+           feature, so that the chromosomes that come in another order than in the reference
+           (the first track), or are missing from it, do not block the other tracks.
+           Nothing is done as long as all the tracks left are on it."""
+        self.aligned = self.chrom
+        self.set_shown(self.chrom)
+        self.disagree = self.disagree or any(self.temp[n] is not None and self.temp[n][0] != self.chrom
+                                             for n in self.available_streams)
+        if not self.disagree: return
+        for n in range(len(self.tracks)):
+            x = self.temp[n]
+            if x is not None and x[0] == self.chrom and n in self.available_streams: continue
+            toc = self.toc(n)
+            if not toc or self.chrom not in toc: continue
+            stream = self.tracks[n].read(fields=self.fields[n],offset=toc[self.chrom])
+            try: self.temp[n] = stream.next()
+            except StopIteration: continue
+            self.streams[n] = stream
+            if n not in self.available_streams:
+                bisect.insort(self.available_streams,n)
+
+    def record(self):
+        """Keep the checkpoint of the page about to be read, unless `read_page` is reading
+           it again. When the checkpoints take more than *self.limit*, every other one is
+           dropped, except the first and the last: the pages in between are read again
+           from the previous checkpoint kept."""
+        if self.replaying: return
+        key = (self.chrom,self.ntimes)
+        checkpoint = self.checkpoint()
+        if checkpoint is None: return
+        if key in self.npages: # read again in follow mode
+            self.checkpoints[key] = checkpoint
+            self.size = self.weight()
+        else:
+            last = self.checkpoints.get(self.history[-1]) if self.history else None
+            self.npages[key] = len(self.history)
+            self.history.append(key)
+            self.checkpoints[key] = checkpoint
+            self.size += self.footprint(checkpoint,last)
+        while self.size > self.limit and len(self.checkpoints) > 2:
+            kept = [k for k in self.history if k in self.checkpoints]
+            for k in kept[1:-1:2]: del self.checkpoints[k]
+            self.size = self.weight()
+
+    def footprint(self,checkpoint,last):
+        """Approximate memory taken by *checkpoint*, in bytes, if *last* is the previous one
+           kept (or None): its copy of the buffer holds references to all the entries, and
+           keeps those made since then, with their rows. All are new if `compact` numbered
+           the entries again in between."""
+        n = len(checkpoint['temp']) + len(checkpoint['rest'])
+        new = n
+        if last is not None and last['epoch'] == checkpoint['epoch']:
+            new = min(n,checkpoint['seq']-last['seq'])
+        return self.checkpoint_size + 8*n + self.entry_size*new
+
+    def weight(self):
+        """Approximate memory taken by all the checkpoints, in bytes."""
+        size = 0
+        last = None
+        for key in self.history:
+            checkpoint = self.checkpoints.get(key)
+            if checkpoint is None: continue
+            size += self.footprint(checkpoint,last)
+            last = checkpoint
+        return size
+
+    def next_page(self):
+        """Move the position to the next page, once a page is read."""
+        if self.chrom_change:
+            self.chrom = self.next_chrom
+            self.ntimes = 1
+        else:
+            self.ntimes += 1
+
+    def read_page(self,key):
+        """Read again the page *key* = (chrom,ntimes) from its checkpoint, or from the last
+           one kept before it and through the pages in between, then come back to the
+           current position. Return None if the streams cannot seek."""
+        current = self.checkpoint()
+        if current is None or key not in self.npages: return None
+        pos = start = self.npages[key]
+        while start >= 0 and self.history[start] not in self.checkpoints: start -= 1
+        if start < 0: return None
+        self.seek(self.checkpoints[self.history[start]])
+        self.replaying = True
+        try:
+            stream = self.read()
+            content = stream.next()
+            for _ in range(pos-start):
+                self.next_page()
+                content = stream.next()
+        finally:
+            self.replaying = False
+        self.seek(current)
         return content
 
-    def go_to_selection(self,streams):
+    def go_to_selection(self):
         """Skip all features not passing the selection filter before filling the buffer."""
+        if profile: t = time.time()
         skipped = 0
-        self.temp = [s.next() for s in streams]
         if self.sel and self.ntimes == 1:
             selected_chrom = self.sel.get('chr',self.chrom)
             selected_start = self.sel.get('start',[0])[0]
-            for i,stream in enumerate(streams):
+            for i,stream in enumerate(self.streams):
+                if self.temp[i] is None: continue
+                # the streams of these tracks start on the selected chromosome (see `open`)
+                seeking = isinstance(self.tracks[i],(Parser,BinaryTrack))
                 try:
                     chrom,start,end = self.temp[i][:3]
                     while chrom != selected_chrom:
+                        if seeking: raise StopIteration # all its features end before the start
                         self.temp[i] = stream.next()
                         chrom,start,end = self.temp[i][:3]
                         skipped += 1
                     while start < selected_start:
                         if end > selected_start: # overlapping
-                            self.temp[i] = (chrom,selected_start,end)+self.temp[i][3:]
+                            if self.nfeat: self.clips[i] = selected_start # see fill()
+                            else: self.temp[i] = (chrom,selected_start,end)+self.temp[i][3:]
                             break
                         else:
                             self.temp[i] = stream.next()
                             chrom,start,end = self.temp[i][:3]
                             skipped += 1
                 except StopIteration:
-                    self.temp.pop(i)
+                    self.temp[i] = None
                     self.available_streams.remove(i)
                 except IndexError:
                     sys.exit("Unknown region.")
             self.chrom = self.sel['chr']
             if self.nbp:
-                temppos = [x[1] for x in self.temp if x[3]!='00']
-                if temppos: self.ntimes += min(temppos) / self.nbp
+                temppos = [x[1] for x in self.temp if x and x[3]!='00']
+                if temppos: self.ntimes += (min(temppos) - selected_start) / self.nbp
                 else: sys.exit("Chromosome %s not found." % self.chrom)
             elif self.nfeat:
                 self.ntimes += skipped / self.nfeat
+        if profile:
+            profile.add('selection',time.time()-t)
+            profile.add('features skipped',skipped)
 
-    def read_nfeat(self,streams):
-        """Yield the next *nfeat* features."""
-        self.temp = [[x,n] for n,x in enumerate(self.temp)]
+    def fill(self):
+        """Load *nfeat* feats of each track in the buffer."""
+        first,self.temp = self.temp,[]
+        clips,self.clips = self.clips,{}
+        for n,x in enumerate(first):
+            if x is None: continue
+            if n in clips: self.clips[self.seq] = clips[n]
+            self.push(x,n)
         toremove = []
-        # Load *nfeat* feats of each track in the buffer
         for n in self.available_streams:
             for _ in range(self.nfeat):
                 try:
-                    self.temp.append([streams[n].next(),n])
+                    self.push(self.streams[n].next(),n)
                 except StopIteration:
                     toremove.append(n)
                     break
         for n in toremove: self.available_streams.remove(n)
+        self.first = self.seq
+
+    def push(self,x,n):
+        """Copy feature *x* of track *n* to a new row of its buffer in *self.bufs*, and make
+           an entry (end,seq,n,row) of it. Return the entry if it belongs to the chromosome
+           of the heap, else add it to *self.rest*. The buffer holds about *nfeat* entries
+           per track, plus those of the checkpoints (see `record`)."""
+        seq = self.seq
+        self.seq += 1
+        if x[0] != self.bufchrom and self.was_shown(x[0]):
+            self.disagree = True
+            if self.toc(n): return # the track was moved to it and back
+        entry = (x[2],seq,n,self.bases[n]+self.bufs[n].append(x))
+        if x[0] == self.bufchrom: return entry
+        self.rest.append(entry)
+
+    def field(self,entry,k):
+        """Return the field number *k* (0 for the chromosome, 1 for the start, 2 for
+           the end, 3 for the name or score) of the feature of *entry*."""
+        n = entry[2]
+        return self.bufs[n].columns[k][entry[3]-self.bases[n]]
+
+    def compact(self):
+        """Drop the rows of the buffer of the features that left it, once there are more
+           than half as many as the others. Else the rows are only appended, so that the
+           checkpoints can share the columns instead of copying them. Since the features
+           mostly leave in the order they were read, the first rows are dropped; if some
+           old feature is still there, e.g. a long one, the rows left are numbered again
+           in new entries."""
+        nrows = len(self.temp) + len(self.rest)
+        if sum(len(b) for b in self.bufs) <= nrows + nrows/2 + self.nfeat: return
+        rows = [[] for _ in self.bufs] # rows still in use
+        for e in itertools.chain(self.temp,self.rest): rows[e[2]].append(e[3])
+        moved = {} # {(n,row): new row}
+        for n,buf in enumerate(self.bufs):
+            dead = len(buf) - len(rows[n])
+            if dead <= len(rows[n])/2 + self.nfeat: continue
+            first = min(rows[n]) if rows[n] else self.bases[n]+len(buf)
+            if first-self.bases[n] >= dead/2: # a new `Batch`, as the checkpoints may share it
+                self.bufs[n] = buf[first-self.bases[n]:]
+                self.bases[n] = first
+                continue
+            new = Batch()
+            for row in sorted(rows[n]):
+                moved[(n,row)] = new.append(buf[row-self.bases[n]])
+            self.bufs[n] = new
+            self.bases[n] = 0
+        if not moved: return
+        def move(e):
+            end,seq,n,row = e
+            return (end,seq,n,moved.get((n,row),row))
+        self.temp = map(move,self.temp) # the same keys: still a heap
+        self.rest = map(move,self.rest)
+        self.epoch += 1
+        self.queue()
+
+    def add(self,page,entry,start,end):
+        """Add the feature of *entry*, from *start* to *end*, to *page*: the columns
+           (starts,ends,others) of its track."""
+        page[0].append(start)
+        page[1].append(end)
+        page[2].append(self.field(entry,3) if len(self.bufs[entry[2]].columns) > 3 else '00')
+
+    def isolate(self):
+        """Put the buffered features of the current chromosome in the heap *self.temp*,
+           and the others in *self.rest*, keeping the order they have in the buffer
+           (the features left from the previous page sorted by end, then all others
+           in the order they were read). The tracks that have none are moved to the
+           chromosome if they have it, like in `align`, unless they were already."""
+        self.set_shown(self.chrom)
+        key = operator.itemgetter(1)
+        left = sorted(e for e in self.temp if e[1] < self.first)
+        new = [e for e in self.temp if e[1] >= self.first]
+        buf = left + [e for e in self.rest if e[1] < self.first] \
+                   + sorted([e for e in self.rest if e[1] >= self.first]+new, key=key)
+        self.temp = []
+        self.rest = []
+        clips,self.clips = self.clips,{}
+        for e in buf:
+            end,seq,n,row = e
+            if self.field(e,0) == self.chrom: # numbered again, since ties are resolved by seq
+                if seq in clips: self.clips[self.seq] = clips[seq]
+                self.temp.append((end,self.seq,n,row))
+                self.seq += 1
+            else:
+                if seq in clips: self.clips[seq] = clips[seq]
+                self.rest.append((end,seq,n,row))
+        self.bufchrom = self.chrom
+        present = set(e[2] for e in self.temp)
+        self.disagree = self.disagree or any(e[2] not in present for e in self.rest)
+        for n in range(len(self.tracks)):
+            if self.chrom == self.aligned or not self.disagree: break
+            toc = self.toc(n) if n not in present else None
+            if not toc or self.chrom not in toc: continue
+            # what was read from this track is read again after the chromosome
+            self.rest = [e for e in self.rest if e[2] != n]
+            self.streams[n] = self.tracks[n].read(fields=self.fields[n],offset=toc[self.chrom])
+            if n not in self.available_streams:
+                bisect.insort(self.available_streams,n)
+            nread = 0
+            for x in itertools.islice(self.streams[n],self.nfeat+1):
+                entry = self.push(x,n)
+                if entry: self.temp.append(entry)
+                nread += 1
+            if nread <= self.nfeat: self.available_streams.remove(n)
+        self.aligned = self.chrom
+        self.queue()
+
+    def queue(self):
+        """Sort the entries of the heap by track, in the order they were read."""
+        self.queues = [deque() for _ in self.streams]
+        for e in sorted(self.temp,key=operator.itemgetter(1)):
+            self.queues[e[2]].append(e)
+        heapq.heapify(self.temp)
+        self.done = set() # seqs of the entries that left the heap but not the queues
+
+    def overlapping(self,n,maxpos):
+        """Return the entry of track *n* that was in the buffer at the beginning of the page,
+           starts before *maxpos* and has the smallest end, or None. Since the features are
+           read sorted by start, only the head of the queue of track *n* is looked at."""
+        queue = self.queues[n]
+        kept = []
+        best = None
+        while queue and self.field(queue[0],1) < maxpos:
+            e = queue.popleft()
+            if e[1] in self.done:
+                self.done.remove(e[1])
+                continue
+            kept.append(e)
+            if e[1] < self.first and self.clips.get(e[1],self.field(e,1)) < maxpos \
+               and (best is None or e < best):
+                best = e
+        queue.extendleft(reversed(kept))
+        return best
+
+    def read_nfeat(self):
+        """Yield the next *nfeat* features."""
+        # The features of the current chromosome are kept in a heap ordered by end
+        # position, then by reading order: one page costs O(nfeat*log(nfeat*ntracks)).
         # Repeat & yield each time the function is called
-        while self.temp:
+        while self.temp or self.rest or self.chrom != self.bufchrom:
+            self.compact()
+            self.record()
             self.chrom_change = False
-            toyield = [[] for _ in streams]
+            toyield = [([],[],[]) for _ in self.streams] # starts, ends, others
             # Isolate one chromosome
-            chrtemp = sorted([x for x in self.temp if x[0][0]==self.chrom], key=lambda x:x[0][2])
-            rest = [x for x in self.temp if x[0][0]!=self.chrom]
-            self.temp = chrtemp+rest
-            if len(chrtemp) <= self.nfeat and rest:
-                self.chrom_change = True
-                self.next_chrom = rest[0][0][0]
+            if self.chrom != self.bufchrom:
+                self.isolate()
+            self.first = self.seq
+            if len(self.temp) <= self.nfeat:
+                heads = {}
+                for e in self.rest: heads.setdefault(e[2],self.field(e,0))
+                self.next_chrom = self.next_chromosome(heads)
+                self.chrom_change = self.next_chrom is not None
             # Load *nfeat* in *toyield*
-            for x,n in chrtemp[:self.nfeat]:
-                toyield[n].append( x[1:3]+(x[3:] or ('00',)) )
+            new = []
+            for _ in range(min(self.nfeat,len(self.temp))):
+                entry = end,seq,n,row = heapq.heappop(self.temp)
+                self.done.add(seq)
+                self.add(toyield[n],entry,self.clips.pop(seq,self.field(entry,1)),end)
                 # Reload the buffer with one element for each element read,
                 # so there are always *nfeat* x ntracks elements
-                try: self.temp.append([streams[n].next(),n])
+                try: entry = self.push(self.streams[n].next(),n)
                 except StopIteration:
                     try: self.available_streams.remove(n)
                     except ValueError: continue
-            self.temp = self.temp[len(chrtemp[:self.nfeat]):]
-            if any(toyield):
+                else:
+                    if entry: new.append(entry)
+            # The new ones are only sorted with the others on the next page
+            for entry in new:
+                heapq.heappush(self.temp,entry)
+                self.queues[entry[2]].append(entry)
+            if any(t[0] for t in toyield):
                 # Add feats that go partially beyond
-                maxpos = max(x[-1][1] for x in toyield if x)
-                unseen = list(self.available_streams) # copy
-                chrtemp = chrtemp[self.nfeat:]
-                for k,feat in enumerate(chrtemp):
-                    x,n = feat
-                    if n in unseen and x[1] < maxpos:
-                        toyield[n].append( (x[1],min(x[2],maxpos))+(x[3:] or ('00',)) )
-                        self.temp[k][0] = (x[0],maxpos,x[2])+x[3:]
-                        unseen.remove(n)
-                    if not unseen: break
-                yield toyield
+                maxpos = max(t[1][-1] for t in toyield if t[0])
+                for n in self.available_streams:
+                    entry = self.overlapping(n,maxpos)
+                    if entry is None: continue
+                    end,seq,n,row = entry
+                    self.add(toyield[n],entry,self.clips.get(seq,self.field(entry,1)),min(end,maxpos))
+                    self.clips[seq] = maxpos
+                yield [Batch(map(Batch.compact,t)) if t[0] else Batch() for t in toyield]
             else: break
 
-    def read_nbp(self,streams):
+    def read_nbp(self):
         """Yield all features in the next *nbp* base pairs window."""
         # Repeat & yield each time the function is called
         shift = self.sel.get('start',[0])[0] if self.sel else 0
-        while self.available_streams:
+        while self.chrom is not None:
+            if self.chrom != self.aligned: self.align()
+            if not self.available_streams: break
+            self.record()
             maxpos = self.ntimes*self.nbp + shift
-            toyield = [[] for _ in streams]
+            toyield = [[] for _ in self.streams]
             toremove = []
             self.chrom_change = False
-            chrom = [self.chrom for _ in streams]
-            # Load items within *nbp* in *toyield*
+            chrom = [self.chrom for _ in self.streams]
+            # Load items within *nbp* in *toyield*, each track in its own process if possible
+            results = {}
+            if self.workers:
+                jobs = [n for n in self.available_streams
+                        if n in self.jobs and self.temp[n][0] == self.chrom]
+                for n in jobs: # always the same process for a track, that keeps its stream open
+                    args = self.jobs[n]+(self.fields[n],self.tracks[n].offset,self.temp[n],self.chrom,maxpos)
+                    results[n] = self.workers[n % len(self.workers)].apply_async(read_job,(args,))
+                for n in jobs: results[n] = results[n].get()
             for n in self.available_streams:
-                x = self.temp[n]
-                while x[0] == self.chrom and x[2] <= maxpos:
-                    toyield[n].append((x[1],x[2],x[3]))
-                    try: x = streams[n].next()
-                    except StopIteration:
-                        toremove.append(n)
-                        self.temp[n] = None
-                        break
-                if x[0] != self.chrom:
-                    chrom[n] = x[0]
-                elif x[2] > maxpos and x[1] < maxpos:
-                    toyield[n].append((x[1],maxpos,x[3]))
-                    x = (x[0],maxpos,x[2],x[3])
+                if n in results:
+                    if not isinstance(results[n],tuple): sys.exit(results[n])
+                    toyield[n],x,end,offset = results[n]
+                    # move the stream of this process to where the worker stopped
+                    self.streams[n] = self.tracks[n].read(fields=self.fields[n],offset=offset)
+                else:
+                    toyield[n],x,end,self.streams[n] = read_window(self.tracks[n],self.streams[n],
+                                                       self.fields[n],self.temp[n],self.chrom,maxpos)
+                if end: toremove.append(n)
+                elif x[0] != self.chrom: chrom[n] = x[0]
                 self.temp[n] = x
             for n in toremove: self.available_streams.remove(n)
             if all(chrom[n] != self.chrom for n in self.available_streams):
-                self.next_chrom = chrom[0]
+                self.next_chrom = self.next_chromosome(dict((n,chrom[n]) for n in self.available_streams))
                 self.chrom_change = True
             if any(toyield):
-                yield toyield
+                yield [t or Batch() for t in toyield]
             else:
-                yield [[(0,0,'00')] for _ in streams]
+                yield [empty_window for _ in self.streams]
+
+###############################################################################
+
+class Pool(object):
+    """Items of a Tk canvas, reused from one page to the next.
+
+    Creating canvas items is slow: instead of deleting them, a new page moves and
+    reconfigures the items of the previous one, hides those it does not need, and only
+    creates new ones when it needs more. Items are grouped by type and set of options,
+    so that a reused item is given all its options again."""
+
+    def __init__(self,canvas):
+        self.canvas = canvas
+        self.items = {}   # {(type,option names): [item id,...]}
+        self.used = {}    # {(type,option names): number of items used by the current page}
+        self.config = {}  # {item id: options}, or None if hidden
+
+    def reset(self):
+        """Start a new page."""
+        self.used = dict.fromkeys(self.items,0)
+
+    def create(self,type,*coords,**options):
+        """Same as `canvas.create_<type>`, but reuse an item if one is available."""
+        key = (type,tuple(sorted(options)))
+        items = self.items.setdefault(key,[])
+        n = self.used.get(key,0)
+        self.used[key] = n+1
+        if n < len(items):
+            if profile: profile.add('items reused',1)
+            item = items[n]
+            self.canvas.coords(item,*coords)
+            if self.config[item] != options:
+                self.canvas.itemconfig(item,state='normal',**options)
+                self.config[item] = options
+        else:
+            if profile: profile.add('items created',1)
+            item = getattr(self.canvas,'create_'+type)(*coords,**options)
+            items.append(item)
+            self.config[item] = options
+        return item
+
+    def hide(self):
+        """Hide the items not used by the current page."""
+        for key,items in self.items.iteritems():
+            for item in items[self.used.get(key,0):]:
+                if self.config[item] is not None:
+                    self.canvas.itemconfig(item,state='hidden')
+                    self.config[item] = None
 
 ###############################################################################
 
 class Drawer(object):
-    def __init__(self,names,types,nfeat,nbp,sel,ylim):
+    def __init__(self,names,types,nfeat,nbp,sel,ylims):
         self.names = names # [file names]
         self.types = types # ['intervals' or 'density']
         self.nfeat = nfeat
         self.nbp = nbp
         self.sel = sel     # selection, of the type {'chr':'chr1','start':(1,1),'end':(2,2)}
-        self.ylim = ylim   # (limits,) for the range of the vertical scale
+        self.ylims = ylims # [{'min':..,'max':..}] range of the vertical scale of each track,
+                           # or {} to fit the scores of each page
         self.ntimes = 0    # number of times the draw function is called
         self.maxpos = 0    # rightmost coordinate to display
         self.minpos = 0    # leftmost coordinate to display
         self.nticks = 10   # number of ticks on the horiz axis if regular scale
         self.keydown = ''
+        self.onkey = None  # function called with *keydown* when a key is pressed
+        # Widgets, created once by `create_window`
+        self.root = None
+        self.canvas = []   # one canvas per track
+        self.pools = {}    # {canvas: `Pool` of its items}
+        self.hover = {}    # {canvas: ([x,...], [(x1,y1,x2,y2,feat name or score),...])}, sorted by x
+        self.motion = None # last <Motion> event not processed yet
         # Geometry
-        self.root = tk.Tk()
         self.WIDTH = 800   # window width
         self.htrack = 30   # canvas height
         self.rmargin = 100 # width of the right margin
@@ -292,30 +2244,13 @@ class Drawer(object):
         self.dens_col = "green"
         self.line_col = "black"
 
-    def draw(self,content,chrom):
-        """Create a new window and draw from the *content* coordinates
+    def draw(self,content,chrom,bounds=None):
+        """Draw from the *content* coordinates
            (of the form [[(1,2,n),(3,4,n)], [(3,5,n),(4,6,n)],...],
-           where `n` is either a name or a score)."""
-        def keyboard(event):
-            if event.keysym == 'Escape':
-                self.keydown = chr(27)
-                self.root.destroy()
-                sys.exit(0)
-            elif event.keysym == 'space':
-                self.keydown = ' '
-                self.root.quit()
-            elif event.keysym == 'Left':
-                self.keydown = chr(37)
-                self.root.quit()
-                pass # backwards??
-            elif event.keysym == 'Right':
-                self.keydown = chr(39)
-                self.root.quit()
-                pass # slowly forward
-            elif event.keysym == 'BackSpace':
-                self.keydown = chr(127)
-                self.root.quit()
-
+           where `n` is either a name or a score).
+           The window is created the first time; the next times, only the content of
+           the canvases and the labels are updated.
+           *bounds* (minpos,maxpos) are given when redrawing a page seen before."""
         def set_boundaries():
             if self.nbp:
                 # first time: shift to selection
@@ -343,23 +2278,80 @@ class Drawer(object):
                 self.reg_bp = self.maxpos - self.minpos
             self.reg_bp = float(max(self.reg_bp,self.nbp))
 
+        if profile: t = time.time()
+        if not self.canvas:
+            self.create_window()
+        if bounds:
+            self.minpos,self.maxpos = bounds
+            self.reg_bp = float(max(self.maxpos-self.minpos,self.nbp))
+        else:
+            set_boundaries()
+        self.draw_tracks(content)
+        self.draw_axis(content)
+        if profile:
+            profile.add('draw',time.time()-t)
+            profile.add('features drawn',sum(len(x) for x in content if x is not empty_window))
+            profile.done((chrom,self.ntimes))
+        self.draw_rmargin(chrom)
+
+    def create_window(self):
+        """Create all the widgets of the window, and bind the keys to *onkey*.
+           The event loop is then started once by the caller (`root.mainloop()`)."""
+        self.root = tk.Tk()
+        def keyboard(event):
+            if event.keysym == 'Escape':
+                self.keydown = chr(27)
+                self.root.destroy()
+                sys.exit(0)
+            elif event.keysym == 'space':
+                self.keydown = ' '
+            elif event.keysym == 'Left':
+                self.keydown = chr(37)
+            elif event.keysym == 'Right':
+                self.keydown = chr(39) # slowly forward
+            elif event.keysym == 'BackSpace':
+                self.keydown = chr(127)
+            else:
+                return
+            if self.onkey: self.onkey(self.keydown)
+
         self.root.title("gless")
         self.root.bind("<Key>", keyboard)
         self.root.config(bg=self.bg)
         self.root.focus_set() # not working?
         self.root.resizable(0,0) # disable window resizing
-        set_boundaries()
         self.draw_labels()
-        self.draw_tracks(content)
-        self.draw_rmargin(chrom)
-        self.draw_axis(content)
+        self.canvas = [tk.Canvas(self.root,height=self.htrack,bd=0,bg=self.canvas_bg,highlightthickness=0)
+                       for _ in self.names]
+        for n,c in enumerate(self.canvas):
+            c.config(width=self.wcanvas)
+            c.grid(row=n,column=1,pady=5)
+            c.bind("<Motion>", self.on_motion)
+        self.thisfeat = tk.Label() # popup showing the name of the feat under the mouse pointer
+        back = tk.Frame(self.root,bg=self.canvas_bg,width=self.wcanvas) # blank background
+        back.grid(column=1,row=0,rowspan=len(self.names),sticky=["N","S"])
+        back.lower()
+        # Right margin
+        self.chrom_label = tk.Label(text='',bg='white')
+        self.chrom_label.grid(row=0,column=2)
+        for n in range(1,len(self.names)):
+            w = tk.Frame(width=self.rmargin,height=self.htrack,bg=self.bg)
+            w.grid(row=n,column=2)
+        # Horizontal scale
+        self.axis = tk.Canvas(self.root,width=self.wcanvas,height=2*self.htrack,bd=0,
+                              bg=self.canvas_bg,highlightthickness=0)
+        self.axis.grid(row=len(self.names)+1,column=1)
+        self.min_label = tk.Label(text='',bd=0,bg=self.bg,anchor='e')
+        self.min_label.grid(row=len(self.names)+1,column=0,sticky='e',padx=5)
+        self.max_label = tk.Label(text='',bd=0,bg=self.bg,anchor='w')
+        self.max_label.grid(row=len(self.names)+1,column=2,sticky='w',padx=5)
+        self.pools = dict((c,Pool(c)) for c in self.canvas+[self.axis])
         try: self.root.wm_attributes("-topmost", 1) # makes the window stay on top
         except: pass # depends on the OS
         def _finish():
             self.root.destroy()
             sys.exit(0)
         self.root.protocol("WM_DELETE_WINDOW", _finish)
-        self.root.mainloop()
 
     def bp2px(self,x,wwidth,reg_bp):
         """Transform base pair coordinates to distances in pixels."""
@@ -374,108 +2366,179 @@ class Drawer(object):
             l.grid(row=n,column=0)
         self.wcanvas = self.WIDTH-self.wlabel-self.rmargin
 
+    def on_motion(self,event):
+        """Motion events come faster than they can be answered: keep only the last one,
+           and show the feature under it when Tk is idle."""
+        if self.motion is None:
+            self.root.after_idle(self.show_feat_name)
+        self.motion = event
+
+    def show_feat_name(self):
+        """Show the name or score of the feature under the mouse pointer."""
+        event,self.motion = self.motion,None
+        canvas = event.widget
+        x = event.x
+        xs,boxes = self.hover.get(canvas,([],[]))
+        k = bisect.bisect_right(xs,x)-1
+        if k >= 0 and x <= boxes[k][2]:
+            x1,y1,x2,y2,name = boxes[k]
+            self.thisfeat.place(x=x1+self.wlabel+(x2-x1)/2.,
+                                y=y1+canvas.winfo_y()+(y2-y1)/2., anchor='center')
+            self.thisfeat.config(text=name,
+                 bd=1,highlightbackground="black",highlightthickness=1)
+            self.thisfeat.lift()
+        else:
+            self.thisfeat.place_forget()
+
     def draw_tracks(self,content):
-        """Draw the canvas with the tracks in the middle."""
-        def show_feat_name(event):
-            canvas = event.widget
-            x,y = event.x, event.y
-            closest = canvas.find_closest(x,y)
-            if canvas.type(closest)=='rectangle':
-                x1,y1,x2,y2 = canvas.coords(closest)
-                # the base line has x=0 and is often closer
-                self.thisfeat.place(x=x1+self.wlabel+(x2-x1)/2.,
-                                    y=y1+canvas.winfo_y()+(y2-y1)/2., anchor='center')
-                self.thisfeat.config(text=name_map[canvas][closest[0]],
-                     bd=1,highlightbackground="black",highlightthickness=1)
-                self.thisfeat.lift()
-            else:
-                self.thisfeat.place_forget()
-        self.thisfeat = tk.Label() # popup showing the name of the feat under the mouse pointer
-        name_map = {} # correspondance canvas object id - feat name or score
+        """Draw the tracks in the canvases in the middle, replacing the previous page."""
+        self.thisfeat.place_forget()
         feat_thk = self.htrack - 2*self.feat_pad
-        canvas = [tk.Canvas(self.root,height=self.htrack,bd=0,bg=self.canvas_bg,highlightthickness=0)
-                  for _ in self.names]
         for n,t in enumerate(content):
             type = self.types[n]
-            c = canvas[n]
-            c.config(width=self.wcanvas)
-            c.grid(row=n,column=1,pady=5)
-            c.bind("<Motion>", show_feat_name)
-            name_map[c] = {}
+            c = self.canvas[n]
+            pool = self.pools[c]
+            pool.reset()
             if type == 'intervals':
-                c.create_line(0,self.htrack/2.,self.WIDTH,self.htrack/2.,fill=self.line_col) # track axis
+                pool.create('line',0,self.htrack/2.,self.WIDTH,self.htrack/2.,fill=self.line_col) # track axis
                 y1,y2 = (0+self.feat_pad,feat_thk+self.feat_pad)
-                for k,feat in enumerate(t):
-                    f1,f2,g = (feat[0],feat[1],feat[2])
+                boxes = []
+                owner = [None]*(int(self.wcanvas)+1) # {pixel: index of the feature on top}
+                for k,(f1,f2,g) in enumerate(t.rows(3)):
                     x1 = self.bp2px(f1-self.minpos,self.wcanvas,self.reg_bp)
                     x2 = self.bp2px(f2-self.minpos,self.wcanvas,self.reg_bp)
                     if f1 == self.minpos: x1-=1 # no border
-                    r = c.create_rectangle(x1,y1,x2,y2,fill=self.feat_col)
+                    pool.create('rectangle',x1,y1,x2,y2,fill=self.feat_col)
                     if g == '00': g = "%d-%d" % (f1,f2)
-                    name_map[c][r] = g
+                    boxes.append((x1,y1,x2,y2,g))
+                    p1,p2 = max(int(x1),0), min(int(x2),len(owner)-1)
+                    if p2 >= p1: owner[p1:p2+1] = [k]*(p2-p1+1)
+                # Features can overlap: index the visible one, drawn last, in each pixel range
+                hover = self.hover[c] = ([],[])
+                for p,k in enumerate(owner):
+                    if k is not None and (p == 0 or owner[p-1] != k):
+                        hover[0].append(p)
+                        hover[1].append(boxes[k])
             elif type == 'density':
                 m = 6 # margin
                 hi = 2 * self.htrack # twice higher than for intervals
                 c.config(height=hi)
+                hover = self.hover[c] = ([],[])
+                ylim = self.ylims[n]
                 if t:
-                    ymax = self.ylim.get('max', max(float(x[2]) for x in t)) # max score to display
-                    ymin = self.ylim.get('min', min(float(x[2]) for x in t)) # min score to display
+                    # max and min scores to display (the last two values of a bin are its min and max)
+                    scores = t.columns[2:]
+                    ymax = ylim['max'] if 'max' in ylim else max(map(float,scores[-1]))
+                    ymin = ylim['min'] if 'min' in ylim else min(map(float,scores[-2 if len(scores)>1 else 0]))
                     yrange = abs(ymax-ymin)
                     if yrange: scale = (hi-2*m) / yrange # score to px
                     else: scale = 1
                     mid = max(0, ymax*scale +m-1)
-                    for k,feat in enumerate(t):
-                        f1,f2,g = (feat[0],feat[1],feat[2])
+                    # More features than pixels: draw one bin per pixel column instead
+                    feats = t if len(t) <= self.wcanvas else Batch(zip(*self.summarize(t)))
+                    # The whole track is a single polygon: its outline goes along the top
+                    # of the features from left to right, then back along their bottom.
+                    top = []
+                    bottom = []
+                    for f1,f2,g,smin,smax in feats.rows(5):
                         x1 = self.bp2px(f1-self.minpos,self.wcanvas,self.reg_bp)
                         x2 = self.bp2px(f2-self.minpos,self.wcanvas,self.reg_bp)
-                        s = float(g)
                         if f1 == self.minpos: x1-=1 # no border
-                        if s > 0:
-                            if s > self.ylim.get('min',-1) > 0:
-                                s = s - self.ylim['min']
-                            if self.ylim.get('max'):
-                                s = min(s,self.ylim['max'])
-                            spx = mid-s*scale -1
+                        if smax is not None: # bin: draw up to its min and/or max, show the mean
+                            if smin >= 0: scores = [smax]
+                            elif smax <= 0: scores = [smin]
+                            else: scores = [smin,smax]
+                            name = "%g [%g,%g]" % (g,smin,smax)
                         else:
-                            if s < self.ylim.get('max',1) < 0:
-                                s = s - self.ylim['max']
-                            if self.ylim.get('min'):
-                                s = max(s,self.ylim['min'])
-                            spx = mid-s*scale +1
-                        r = c.create_rectangle(x1,mid,x2,spx,fill=self.dens_col)
-                        name_map[c][r] = str(g)
+                            scores = [float(g)]
+                            name = str(g)
+                        y1 = y2 = mid
+                        for s in scores:
+                            if s > 0:
+                                if s > ylim.get('min',-1) > 0:
+                                    s = s - ylim['min']
+                                if ylim.get('max'):
+                                    s = min(s,ylim['max'])
+                                spx = mid-s*scale -1
+                            else:
+                                if s < ylim.get('max',1) < 0:
+                                    s = s - ylim['max']
+                                if ylim.get('min'):
+                                    s = max(s,ylim['min'])
+                                spx = mid-s*scale +1
+                            y1,y2 = min(y1,spx),max(y2,spx)
+                        top.extend((x1,mid,x1,y1,x2,y1,x2,mid))
+                        bottom.append((x2,mid,x2,y2,x1,y2,x1,mid))
+                        hover[0].append(x1)
+                        hover[1].append((x1,y1,x2,y2,name))
+                    for b in reversed(bottom):
+                        top.extend(b)
+                    pool.create('polygon',*top,fill=self.dens_col,outline=self.dens_col)
                     ymax_px = m
                     ymin_px = yrange*scale + m
                     if ymax > 0:
-                        c.create_line(0,ymax_px,5,ymax_px) # little horizontal tick, max
-                        c.create_text(6,ymax_px,text=str(ymax),anchor='w') # max label
+                        pool.create('line',0,ymax_px,5,ymax_px) # little horizontal tick, max
+                        pool.create('text',6,ymax_px,text=str(ymax),anchor='w') # max label
                     if ymin < 0:
-                        c.create_line(0,ymin_px,5,ymin_px) # little horizontal tick, min
-                        c.create_text(6,ymin_px,text=str(ymin),anchor='w') # min label
-                    c.create_line(2,max(ymin_px,mid),2,min(mid,ymax_px)) # vertical scale
+                        pool.create('line',0,ymin_px,5,ymin_px) # little horizontal tick, min
+                        pool.create('text',6,ymin_px,text=str(ymin),anchor='w') # min label
+                    pool.create('line',2,max(ymin_px,mid),2,min(mid,ymax_px)) # vertical scale
                     bl = min(hi-1,max(0, ymax*scale +m-1)) # position of the baseline
-                    c.create_line(0,bl,self.wcanvas,bl,fill=self.line_col) # baseline
+                    pool.create('line',0,bl,self.wcanvas,bl,fill=self.line_col) # baseline
                 else:
-                    c.create_line(0,hi/2,self.wcanvas,hi/2,fill=self.line_col,dash=1) # baseline
-        back = tk.Frame(self.root,bg=self.canvas_bg,width=self.wcanvas) # blank background
-        back.grid(column=1,row=0,rowspan=len(self.names),sticky=["N","S"])
-        back.lower()
+                    pool.create('line',0,hi/2,self.wcanvas,hi/2,fill=self.line_col,dash=1) # baseline
+            pool.hide()
+
+    def summarize(self,t):
+        """Reduce the features *t* of a density track to at most one bin per pixel column
+           of the canvas, so that the size of the polygon does not depend on the number
+           of features. Return a list of (start,end,mean,min,max), where the mean is
+           weighted by the length covered, and neighbouring bins that are equal are merged.
+           *t* can also contain bins already, from a zoom level of a `Pyramid`."""
+        npx = max(int(self.wcanvas),1)
+        bpp = self.reg_bp / npx # bp per pixel
+        minpos = self.minpos
+        bins = {} # {pixel: [sum of score*length, length, min, max]}
+        for f1,f2,s,smin,smax in t.rows(5):
+            s = float(s)
+            if smax is None: smin = smax = s
+            p1 = max(int((f1-minpos)/bpp),0)
+            p2 = min(int((f2-minpos)/bpp),npx-1)
+            for p in xrange(p1,p2+1):
+                w = min(f2,minpos+(p+1)*bpp) - max(f1,minpos+p*bpp)
+                if w < 0 or (w == 0 and f2 > f1): continue # only touches the pixel
+                b = bins.get(p)
+                if b is None:
+                    bins[p] = [s*w,w,smin,smax]
+                else:
+                    b[0] += s*w
+                    b[1] += w
+                    if smin < b[2]: b[2] = smin
+                    if smax > b[3]: b[3] = smax
+        summary = []
+        for p in sorted(bins):
+            b = bins[p]
+            mean = b[0]/b[1] if b[1] else b[2]
+            last = summary[-1] if summary else None
+            if last and last[1] == minpos+p*bpp and last[2:] == [mean,b[2],b[3]]:
+                last[1] = minpos+(p+1)*bpp
+            else:
+                summary.append([minpos+p*bpp,minpos+(p+1)*bpp,mean,b[2],b[3]])
+        return summary
 
     def draw_rmargin(self,chrom):
-        """Add a blank frame on the right as a margin, and the chromosome name."""
-        w = tk.Label(text=chrom,bg='white')
-        w.grid(row=0,column=2)
-        for n in range(1,len(self.names)):
-            w = tk.Frame(width=self.rmargin,height=self.htrack,bg=self.bg)
-            w.grid(row=n,column=2)
+        """Write the chromosome name in the right margin, and the stats of the page if profiling."""
+        if profile:
+            chrom += '\n\n' + profile.status((chrom,self.ntimes))
+        self.chrom_label.config(text=chrom)
 
     def draw_axis(self,content):
         """Draw the horizontal scale."""
-        c = tk.Canvas(self.root,width=self.wcanvas,height=2*self.htrack,bd=0,
-                      bg=self.canvas_bg,highlightthickness=0)
-        c.grid(row=len(self.names)+1,column=1)
+        c = self.axis
+        pool = self.pools[c]
+        pool.reset()
         pad = c.winfo_reqheight()/2.
-        c.create_line(0,pad,self.WIDTH,pad,fill=self.line_col)  # axis
+        pool.create('line',0,pad,self.WIDTH,pad,fill=self.line_col)  # axis
         if sum(len(c) for c in content) <= 10*len(content):
             for n,t in enumerate(content):
                 for k,feat in enumerate(t):
@@ -483,53 +2546,99 @@ class Drawer(object):
                     x1 = self.bp2px(f1-self.minpos,self.wcanvas,self.reg_bp)
                     x2 = self.bp2px(f2-self.minpos,self.wcanvas,self.reg_bp)
                     # ticks
-                    c.create_line(x1,pad,x1,pad-5,fill=self.line_col)
-                    c.create_line(x2,pad,x2,pad+5,fill=self.line_col)
+                    pool.create('line',x1,pad,x1,pad-5,fill=self.line_col)
+                    pool.create('line',x2,pad,x2,pad+5,fill=self.line_col)
                     # labels
                     if f1!=self.minpos and f1!=self.maxpos:
-                        c.create_text(x1,pad-5,text=str(f1),anchor='s')
+                        pool.create('text',x1,pad-5,text=str(f1),anchor='s')
                     if f2!=self.minpos and f2!=self.maxpos:
-                        c.create_text(x2,pad+5,text=str(f2),anchor='n')
+                        pool.create('text',x2,pad+5,text=str(f2),anchor='n')
         else: # regular, linear scale
             ticksize = (self.maxpos-self.minpos) // self.nticks or 1
             for n,k in enumerate(range(self.minpos+ticksize,self.maxpos,ticksize)):
                 x = self.bp2px(k-self.minpos,self.wcanvas,self.reg_bp)
                 if n%2 == 0:
-                    c.create_line(x,pad,x,pad-5,fill=self.line_col)
-                    c.create_text(x,pad-5,text=str(k),anchor='s')
+                    pool.create('line',x,pad,x,pad-5,fill=self.line_col)
+                    pool.create('text',x,pad-5,text=str(k),anchor='s')
                 else:
-                    c.create_line(x,pad,x,pad+5,fill=self.line_col)
-                    c.create_text(x,pad+5,text=str(k),anchor='n')
-        min_label = tk.Label(text=str(self.minpos),bd=0,bg=self.bg,anchor='e')
-        min_label.grid(row=len(self.names)+1,column=0,sticky='e',padx=5)
-        max_label = tk.Label(text=str(self.maxpos),bd=0,bg=self.bg,anchor='w')
-        max_label.grid(row=len(self.names)+1,column=2,sticky='w',padx=5)
+                    pool.create('line',x,pad,x,pad+5,fill=self.line_col)
+                    pool.create('text',x,pad+5,text=str(k),anchor='n')
+        pool.hide()
+        self.min_label.config(text=str(self.minpos))
+        self.max_label.config(text=str(self.maxpos))
 
 ###############################################################################
 
 class Gless(object):
-    def __init__(self,trackList,nfeat,nbp,sel,ylim):
+    poll_delay = 500 # time between two checks for new features in follow mode, in ms
+
+    def __init__(self,trackList,nfeat,nbp,sel,ylim,memory=100,cache=False,jobs=1,follow=False,
+                 sort=False):
+        self.names = [os.path.basename(t) for t in trackList]
+        if not follow:
+            trackList = [self.normalize(t,sort,memory,jobs) for t in trackList]
         self.trackList = trackList
         self.nfeat = nfeat
         self.nbp = nbp
         self.sel = self.parse_selection(sel)
-        self.names = [os.path.basename(t) for t in trackList]
-        self.types = [self.get_type(n) for n in self.names]
+        self.follow = follow
+        if follow: # binary copies and zoom levels would be outdated as soon as the files grow
+            self.tracks = [Parser(t) for t in trackList]
+            for t in self.tracks: t.follow = True
+        else:
+            self.tracks = [open_track(t,cache) for t in trackList]
+        self.types = [self.get_type(t) for t in self.tracks]
         self.stream = None
+        self.prefetcher = None
         self.content = None
+        self.chrom_change = False # whether the last page read ends its chromosome
         self.needtodraw = True
+        # With -b, the window of each track can be read in a separate process. Each is
+        # a pool of one, started before the window is created so that it does not share it.
+        self.workers = []
+        if jobs > 1 and nbp:
+            self.workers = [multiprocessing.Pool(1) for _ in range(min(jobs,len(trackList)))]
         ylim = self.get_score_limits(ylim)
-        self.reader = Reader(self.trackList,self.nfeat,self.nbp,self.sel,self.types)
-        self.drawer = Drawer(self.names,self.types,self.nfeat,self.nbp,self.reader.sel,ylim)
-        self.memory = Memory() # Not working yet
-
-    def get_type(self,filename):
-        """Return whether it is a track with 'intervals' or a 'density'."""
-        with track(filename) as t:
-            if t.format.lower() in ['bed','sam','bam']:
-                return 'intervals'
-            elif t.format.lower() in ['bedgraph','wig','bigWig','sga']:
-                return 'density'
+        ylims = [ylim or ({} if follow else self.score_limits(t)) for t in self.tracks]
+        self.drawer = Drawer(self.names,self.types,self.nfeat,self.nbp,self.sel,ylims)
+        if not follow:
+            self.tracks = [self.zoom(t,cache) for t in self.tracks]
+        # a quarter of *memory* for the checkpoints of the reader, the rest for the pages
+        self.reader = Reader(self.tracks,self.nfeat,self.nbp,self.sel,self.types,self.workers,
+                             memory/4.)
+        self.memory = Memory(memory*3/4.)
+        self.sizes = [os.path.getsize(t.path) for t in self.tracks] if follow else None
+
+    def normalize(self,t,sort=False,memory=100,jobs=1):
+        """Return the path of the sorted copy of the track *t* if it has one, else *t*.
+           If *sort* is True, check first whether *t* is sorted (see `Index`), and make
+           the copy with `sort_track` if it is not, using about *memory* MB."""
+        if track_format(t).lower() not in ['bed','bedgraph']:
+            return t
+        copy = sorted_copy(t)
+        if copy:
+            return copy
+        if sort and not Index(t).load().sorted:
+            print >>sys.stderr, "Sorting %s..." % t
+            return sort_track(t,memory=memory,jobs=jobs)
+        return t
+
+    def get_type(self,t):
+        """Return whether the track *t* has 'intervals' or is a 'density'."""
+        if t.format.lower() in ['bed','sam','bam']:
+            return 'intervals'
+        elif t.format.lower() in ['bedgraph','wig','bigWig','sga']:
+            return 'density'
+
+    def zoom(self,t,build=False):
+        """In -b mode, return the coarsest zoom level of the density track *t* that still has
+           at least one bin per pixel, building its `Pyramid` first if *build* is True.
+           Else return *t* itself."""
+        if not (self.nbp and isinstance(t,(Parser,BinaryTrack)) and self.get_type(t) == 'density'):
+            return t
+        if build and not Pyramid.levels(t.path):
+            Pyramid.build(t.path)
+        return Pyramid.open(t.path,float(self.nbp)/self.drawer.WIDTH) or t
 
     def parse_selection(self,sel):
         """Transform 'chr1:12' into {'chr':'chr1','start':(12,12)}."""
@@ -541,91 +2650,251 @@ class Gless(object):
             return {'chr':sel}
         else: sys.exit("Bad region formatting, got '-s %s' ." % sel)
 
+    def score_limits(self,t):
+        """Return the range of the vertical scale of track *t* when it is not given with -y:
+           for a bedGraph, the 0.1% and 99.9% quantiles of its scores (see `Stats`), with 0,
+           so that it is the same on every page and a few outliers do not flatten the rest.
+           Else {}: it fits the scores of each page."""
+        if self.get_type(t) != 'density' or not isinstance(t,(Parser,BinaryTrack)):
+            return {}
+        stats = Stats(t.path).load()
+        lo,hi = (stats.quantile(0.001),stats.quantile(0.999))
+        if lo is None: return {}
+        return {'min':float('%.3g' % min(lo,0.)), 'max':float('%.3g' % max(hi,0.))}
+
     def get_score_limits(self,ylim):
         """Transform '5,100' into {'min':5,'max':100}."""
         if not ylim: return {}
         elif len(ylim.split(','))==1: return {'max':float(ylim)}
         elif len(ylim.split(','))==2: return {'min':float(ylim.split(',')[0]),
                                               'max':float(ylim.split(',')[1])}
-        else: sys.exit("Wrong format for -f option: got %s." % ylim)
+        else: sys.exit("Wrong format for -y option: got %s." % ylim)
 
     def __call__(self):
         """Main controller function."""
         self.stream = self.reader.read()
-        try: self.content = self.stream.next()
-        except StopIteration:
-            sys.exit("Nothing to show")
-        chrom = self.reader.chrom
-        while True:
-            if self.needtodraw:
-                self.drawer.ntimes = self.reader.ntimes
-                self.drawer.draw(self.content,chrom)
-                self.needtodraw = False
-                if self.reader.chrom_change:
-                    self.reader.chrom = self.reader.next_chrom
-                chrom = self.reader.chrom
-            if self.drawer.keydown == chr(27): # "Esc" pressed: quit
-                sys.exit(0)
-            elif self.drawer.keydown == ' ': # "Space" pressed: next
-                self.fast_forward()
-            elif self.drawer.keydown == chr(127): # "BackSpace" ("Delete") pressed: return
-                self.return_to_beginning()
-                chrom = self.reader.chrom
-            elif self.drawer.keydown == chr(37): # Left arrow pressed: shift left
-                self.slow_reward()
-            elif self.drawer.keydown == chr(39): # Right arrow pressed: shift right
-                self.slow_forward()
+        self.prefetcher = Prefetcher(self.reader,self.stream)
+        try:
+            page = self.prefetcher.get()
+            if page is None:
+                sys.exit("Nothing to show")
+            key,self.content,self.chrom_change = page
+            self.memory.save(key,self.content)
+            self.drawer.onkey = self.keypress
+            self.show()
+            if self.follow:
+                self.drawer.root.after(self.poll_delay,self.poll)
+            self.drawer.root.mainloop() # until ESC is pressed
+        finally:
+            self.prefetcher.stop()
+            for w in self.workers: w.terminate()
+            if profile: profile.save()
+
+    def show(self):
+        """Draw the current page if it changed."""
+        if self.needtodraw:
+            chrom,ntimes = self.memory.key()
+            self.drawer.ntimes = ntimes
+            self.drawer.draw(self.content,chrom,self.memory.bounds[(chrom,ntimes)])
+            self.memory.bounds[(chrom,ntimes)] = (self.drawer.minpos,self.drawer.maxpos)
+            self.needtodraw = False
+
+    def poll(self):
+        """In follow mode, called every *poll_delay* ms. If the last page is displayed and
+           the files have grown, read it again from its checkpoint with the new features,
+           and redraw it if they are inside. The pages after it are then read as usual."""
+        sizes = [os.path.getsize(t.path) for t in self.tracks]
+        key = self.memory.key()
+        checkpoint = self.reader.checkpoints.get(key)
+        if sizes != self.sizes and checkpoint and self.memory.at_head() and self.prefetcher.at_end():
+            self.sizes = sizes
+            self.prefetcher.stop()
+            self.reader.seek(checkpoint)
+            self.reader.resume()
+            self.stream = self.reader.read()
+            self.prefetcher = Prefetcher(self.reader,self.stream)
+            page = self.prefetcher.get()
+            if page is not None and page[1] != self.content:
+                key,self.content,self.chrom_change = page
+                self.memory.cache(key,self.content)
+                if self.nfeat and self.memory.bounds[key]: # the page can be longer now
+                    minpos = self.memory.bounds[key][0]
+                    self.memory.bounds[key] = (minpos,max(t[-1][1] for t in self.content if t))
+                self.needtodraw = True
+                self.show()
+            elif page is not None:
+                self.chrom_change = page[2]
+        self.drawer.root.after(self.poll_delay,self.poll)
+
+    def keypress(self,key):
+        """Called by the drawer when a key is pressed."""
+        if key == chr(27): # "Esc" pressed: quit
+            sys.exit(0)
+        elif key == ' ': # "Space" pressed: next
+            self.fast_forward()
+        elif key == chr(127): # "BackSpace" ("Delete") pressed: return
+            self.return_to_beginning()
+        elif key == chr(37): # Left arrow pressed: shift left
+            self.slow_reward()
+        elif key == chr(39): # Right arrow pressed: shift right
+            self.slow_forward()
+        self.show()
+
+    def bench(self,npages):
+        """Read and draw *npages* pages one after the other (the whole first chromosome if
+           *npages* is 0) without waiting for keys, and print the time spent on each.
+           Drawing needs a display, which can be virtual (e.g. `xvfb-run gless --bench ...`):
+           without one, only reading is timed."""
+        reader = Prefetcher(self.reader,self.reader.read()) # used without its thread
+        draw = True
+        nfeats = tread = tdraw = 0
+        print "%5s %-20s %9s %10s %10s" % ('page','chrom:page','features','read (ms)','draw (ms)')
+        n = 0
+        while n < npages or not npages:
+            t0 = time.time()
+            page = reader.read()
+            t1 = time.time()
+            if page is None: break
+            (chrom,ntimes),content,chrom_change = page
+            if draw:
+                try:
+                    self.drawer.ntimes = ntimes
+                    self.drawer.draw(content,chrom)
+                    self.drawer.root.update() # render it now
+                except tk.TclError, e:
+                    draw = False
+                    print >>sys.stderr, "Cannot draw (%s): only reading is timed." % e
+            t2 = time.time()
+            nfeat = sum(len(t) for t in content if t is not empty_window)
+            print "%5d %-20s %9d %10.1f %10s" % (n+1,"%s:%d"%(chrom,ntimes),nfeat,1000*(t1-t0),
+                                                 "%.1f"%(1000*(t2-t1)) if draw else '-')
+            nfeats += nfeat
+            tread += t1-t0
+            tdraw += t2-t1
+            n += 1
+            if chrom_change:
+                if not npages: break
+                self.reinit()
+        if self.drawer.root and draw: self.drawer.root.destroy()
+        print "%d pages, %d features: reading %.2fs, drawing %.2fs, %d features/s" \
+              % (n,nfeats,tread,tdraw,nfeats/max(tread+tdraw,1e-6))
+        if resource:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # kB, bytes on OSX
+            print "Peak memory: %.1f MB" % (rss / (1024.**2 if sys.platform == 'darwin' else 1024.))
+        if profile: profile.save()
+        return 0
 
     def reinit(self):
-        """Called after chrom change or returning to the beginning."""
+        """Called after chrom change. The reader itself is moved by the `Prefetcher`."""
         self.drawer.minpos = 0
         self.drawer.maxpos = 0
-        self.reader.ntimes = 1
 
     def load_next(self):
-        """Load next set of features and draw the new figure."""
-        try:
-            self.content = self.stream.next() # Load next data
-            for w in self.drawer.root.children.values(): # Clear the window
-                w.destroy()
-        except StopIteration:
+        """Load next set of features (already read by the prefetcher, if it had time)
+           and draw the new figure."""
+        page = self.prefetcher.get()
+        if page is None:
             print "End of file"
             if self.nfeat:
-                self.reader.ntimes -= 1
                 self.drawer.ntimes -= 1
+        else:
+            key,self.content,self.chrom_change = page
+            self.memory.save(key,self.content)
+        self.needtodraw = True
+
+    def load_page(self,pos):
+        """Draw again the page at index *pos* of the history: from memory if it is still
+           there, else read it again starting from its checkpoint."""
+        self.prefetcher.stop() # also after BackSpace: the reader may be needed here
+        key = self.memory.history[pos]
+        content = self.memory.load(key)
+        if content is None:
+            content = self.reader.read_page(key)
+        if content is None: # not seekable: read again from the beginning
+            reader = Reader([self.zoom(open_track(t)) for t in self.trackList],
+                            self.nfeat,self.nbp,self.sel,self.types,self.workers)
+            stream = reader.read()
+            content = stream.next()
+            for _ in range(pos):
+                reader.next_page()
+                content = stream.next()
+        self.memory.cache(key,content)
+        self.memory.pos = pos
+        self.content = content
         self.needtodraw = True
-        for w in self.drawer.root.children.values(): # Clear the window
-            w.destroy()
 
     def return_to_beginning(self):
-        self.reinit()
-        self.reader = Reader(self.trackList,self.nfeat,self.nbp,self.sel,self.types)
-        self.stream = self.reader.read()
-        self.load_next()
+        self.load_page(0)
 
     def fast_forward(self):
-        if self.reader.chrom_change:
+        if not self.memory.at_head(): # after going back
+            self.load_page(self.memory.pos+1)
+            return
+        if self.chrom_change:
             self.reinit()
         else:
-            self.reader.ntimes += 1
             self.drawer.ntimes += 1
         self.load_next()
 
     def slow_forward(self):
+        if not self.memory.at_head(): # after going back
+            self.load_page(self.memory.pos+1)
+            return
         self.load_next()
 
     def fast_reward(self):
-        self.load_next()
+        """Go back to the previous page."""
+        self.load_page(max(0,self.memory.pos-1))
 
     def slow_reward(self):
-        self.load_next()
+        self.fast_reward()
 
 ###############################################################################
 
+def index(argv):
+    """`gless index <file> ...`: (re)build the index of the files used by -s."""
+    parser = argparse.ArgumentParser(prog="gless index",
+                       description="Index bed/bedGraph files to select regions quickly with -s.")
+    parser.add_argument('file', nargs='+', help='A set of track files, separated by spaces')
+    args = parser.parse_args(argv)
+    for f in args.file:
+        idx = Index(f)
+        idx.build()
+        idx.write()
+        print idx.ipath
+    return 0
+
+def sort(argv):
+    """`gless sort <file> ...`: make the sorted copies of the files, read instead of them."""
+    parser = argparse.ArgumentParser(prog="gless sort",
+                       description="Sort bed/bedGraph files by chromosome (in the order they first \
+                                    appear), then by position. By default, the result is saved as \
+                                    a hidden file next to the track, that gless reads instead of it.")
+    parser.add_argument('-o','--output', default=None,
+                       help="Write the sorted file there instead (only one input file).")
+    parser.add_argument('-m','--memory', default=100, type=int,
+                       help="Approximate maximum memory to use, in MB. [100]")
+    parser.add_argument('-j','--jobs', default=1, type=int,
+                       help="Number of processes sorting the chunks of the file. [1]")
+    parser.add_argument('file', nargs='+', help='A set of track files, separated by spaces')
+    args = parser.parse_args(argv)
+    if args.output and len(args.file) > 1:
+        parser.error("-o can only be used with one file")
+    for f in args.file:
+        if args.output is None and Index(f).load().sorted:
+            print >>sys.stderr, "%s is already sorted" % f
+            continue
+        print sort_track(f,args.output,args.memory,args.jobs)
+    return 0
+
 def main():
+    if sys.argv[1:2] == ['index']:
+        return index(sys.argv[2:])
+    if sys.argv[1:2] == ['sort']:
+        return sort(sys.argv[2:])
     parser = argparse.ArgumentParser(description="Graphical 'less' for track files\n. \
-                       Press the SPACE bar to read forward, RETURN (or Delete) to \
-                       return to the beginning, ESC to quit.")
+                       Press the SPACE bar to read forward, the LEFT arrow to go back, \
+                       RETURN (or Delete) to return to the beginning, ESC to quit.")
     parser.add_argument('-n','--nfeat', default=10, type=int,
                        help="Number of features to display, exclusive with -b. [10]")
     parser.add_argument('-b','--nbp', default=None, type=int,
@@ -639,11 +2908,56 @@ def main():
                             (e.g. -y 10) indicates the max positive value to display; \
                             two numbers separated by a comma indicate the min and the max. \
                             For negative values, make sure to use the equal sign (e.g. -y=-5,10).")
+    parser.add_argument('-m','--memory', default=100, type=int,
+                       help="Maximum memory used to keep the pages already seen, and where \
+                             to read them again, in MB. Also used to sort with --sort. [100]")
+    parser.add_argument('-f','--follow', action='store_true', default=False,
+                       help="Follow the files as they grow, like 'tail -f'. A file given as '-' \
+                             is read from the standard input, and implies -f.")
+    parser.add_argument('--sort', action='store_true', default=False,
+                       help="Check whether the bed/bedGraph files are sorted, and sort those \
+                             that are not before reading them (see 'gless sort').")
+    parser.add_argument('-c','--cache', action='store_true', default=False,
+                       help="Create a binary copy of bed/bedGraph files that do not have one yet, \
+                             which is much faster to read the next times.")
+    parser.add_argument('-j','--jobs', default=1, type=int,
+                       help="With -b, number of processes reading the tracks in parallel. [1]")
+    parser.add_argument('--bench', nargs='?', const=100, default=None, type=int, metavar='NPAGES',
+                       help="Read and draw NPAGES pages (100 if not given, the whole first \
+                             chromosome if 0) without waiting for keys, print the time spent \
+                             on each, and exit.")
+    parser.add_argument('--profile', nargs='?', const='gless_profile',
+                        default=os.environ.get('GLESS_PROFILE'), metavar='PREFIX',
+                       help="Time the reading and drawing of each page and count the features \
+                             and canvas items, show it in the right margin, and save it in \
+                             PREFIX.json and PREFIX.prof (cProfile) at exit. [gless_profile]")
+    parser.add_argument('--build-cache', action='store_true', default=False,
+                       help="Only create (or update) the binary copy of the files, and exit.")
     parser.add_argument('file', nargs='+', default=None,
                        help='A set of track files, separated by spaces')
     args = parser.parse_args()
+    if args.build_cache:
+        for f in args.file:
+            if BinaryTrack.build(f):
+                print cache_path(f,'.glb')
+            if track_format(f).lower() == 'bedgraph':
+                Pyramid.build(f)
+                for binsize,ext in Pyramid.levels(f):
+                    print cache_path(f,ext)
+                print Stats(f).load().spath
+        return 0
     if args.nbp: args.nfeat = None
-    Gless(args.file,args.nfeat,args.nbp,args.sel,args.ylim)()
+    if '-' in args.file:
+        args.follow = True
+        args.file = [spool(sys.stdin) if f == '-' else f for f in args.file]
+    if args.profile:
+        global profile
+        profile = Profile(args.profile)
+    g = Gless(args.file,args.nfeat,args.nbp,args.sel,args.ylim,args.memory,args.cache,args.jobs,
+              args.follow,args.sort)
+    if args.bench is not None:
+        return g.bench(args.bench)
+    g()
 
 if __name__ == '__main__':
     sys.exit(main())
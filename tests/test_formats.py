@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""
+Tests of the files that gless.py reads or writes next to the tracks: the binary copy,
+the index, compressed tracks, sorted copies and the statistics of the scores.
+
+Usage: python tests/test_formats.py
+"""
+
+import os,sys,imp,gzip,zlib,struct,random,shutil,tempfile,unittest
+
+gless = imp.load_source('gless',os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','gless.py'))
+
+def make_bed(path,nlines,seed=0):
+    """Write a sorted bed file with a few long features, overlapping many others."""
+    random.seed(seed)
+    with open(path,'w') as f:
+        for chrom in ['chr1','chr2','chrX']:
+            pos = 0
+            for n in xrange(nlines):
+                pos += random.randint(0,100)
+                length = random.randint(50000,200000) if n % 500 == 7 else random.randint(1,300)
+                f.write("%s\t%d\t%d\tfeat%d\n" % (chrom,pos,pos+length,n))
+
+def make_bedgraph(path,nlines,seed=0):
+    random.seed(seed)
+    with open(path,'w') as f:
+        for chrom in ['chr1','chr2']:
+            pos = 0
+            for n in xrange(nlines):
+                start = pos + random.randint(0,20)
+                pos = start + random.randint(1,30)
+                f.write("%s\t%d\t%d\t%s\n" % (chrom,start,pos,random.choice(
+                        [0,random.expovariate(1),-random.expovariate(1)])))
+
+def bgzip(path,out,size=20000):
+    """Compress *path* to *out* as BGZF blocks of *size* bytes, like `bgzip`."""
+    with open(path,'rb') as f: data = f.read()
+    with open(out,'wb') as o:
+        for i in range(0,len(data),size)+[len(data)]: # the last block is empty
+            chunk = data[i:i+size]
+            c = zlib.compressobj(6,zlib.DEFLATED,-15)
+            cdata = c.compress(chunk) + c.flush()
+            o.write('\x1f\x8b\x08\x04' + '\0'*4 + '\0\xff' + struct.pack('<H',6) + 'BC'
+                    + struct.pack('<HH',2,len(cdata)+25))
+            o.write(cdata + struct.pack('<II',zlib.crc32(chunk) & 0xffffffff,len(chunk)))
+
+def features(stream,n=None):
+    return [tuple(x) for x,_ in zip(stream,xrange(n) if n else iter(int,1))]
+
+class TestFormats(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bed = os.path.join(self.dir,'test.bed')
+        make_bed(self.bed,3000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def selections(self):
+        random.seed(1)
+        for chrom in ['chr1','chr2','chrX','chrY']:
+            for start in [0,1,70000]+[random.randint(0,160000) for _ in range(20)]+[10**9]:
+                yield {'chr':chrom,'start':(start,start)}
+
+    def test_binary_selection(self):
+        """Reading a region from the binary copy gives the same features as from the text."""
+        self.assertTrue(gless.BinaryTrack.build(self.bed))
+        text = gless.Parser(self.bed)
+        binary = gless.BinaryTrack(self.bed)
+        self.assertEqual(features(binary.read()),features(text.read()))
+        for sel in self.selections():
+            self.assertEqual(features(binary.read(selection=sel),50),
+                             features(text.read(selection=sel),50),sel)
+
+    def test_index(self):
+        """The index finds the first feature that ends after the start of the region."""
+        lines = [l.split('\t') for l in open(self.bed)]
+        for sel in self.selections():
+            chrom,start = sel['chr'],sel['start'][0]
+            expected = [l for l in lines if l[0] == chrom and int(l[2]) > start][:1]
+            found = features(gless.Parser(self.bed).read(selection=sel),1)
+            self.assertEqual([(x[0],x[1],x[2]) for x in found],
+                             [(l[0],int(l[1]),int(l[2])) for l in expected],sel)
+        index = gless.Index(self.bed).load()
+        self.assertTrue(index.sorted)
+        self.assertEqual(sorted(index.chroms),['chr1','chr2','chrX'])
+
+    def test_index_follow(self):
+        """The index of a growing track only reads the lines added, and is the same as if
+           it was built again. The last line is not indexed until it is complete."""
+        lines = open(self.bed).readlines()
+        path = os.path.join(self.dir,'growing.bed')
+        complete = os.path.join(self.dir,'complete.bed')
+        build = gless.Index.build
+        for k,b in enumerate([1000,3000,3001,6500,len(lines)]): # 3000: first line on chr2
+            with open(path,'w') as f: f.write(''.join(lines[:b]) + ''.join(lines[b:b+1])[:9])
+            with open(complete,'w') as f: f.writelines(lines[:b])
+            if k: gless.Index.build = None # not called again
+            try: index = gless.Index(path).load(follow=True)
+            finally: gless.Index.build = build
+            expected = gless.Index(complete).load()
+            self.assertEqual(index.end,os.path.getsize(complete))
+            for index in [index,gless.Index(path).load(follow=True)]: # and as saved
+                self.assertEqual(sorted(index.chroms),sorted(expected.chroms))
+                for chrom,x in expected.chroms.iteritems():
+                    self.assertEqual(index.chroms[chrom][1:],x[1:])
+                    self.assertEqual([index.seek(chrom,i*index.binsize) for i in range(x[1])],
+                                     [expected.seek(chrom,i*index.binsize) for i in range(x[1])])
+        for p in [path,complete]: # written again, longer: built again
+            with open(p,'w') as f: f.writelines(lines[1:]+lines[:2])
+        index = gless.Index(path).load(follow=True)
+        self.assertEqual(index.chroms,gless.Index(complete).load().chroms)
+
+    def test_compressed(self):
+        """gzip and BGZF tracks read the same as the plain file, from the top or a region."""
+        plain = gless.Parser(self.bed)
+        gz = self.bed+'.gz'
+        with open(self.bed,'rb') as f, gzip.open(gz,'wb') as o: o.write(f.read())
+        bgz = os.path.join(self.dir,'test.bgz.bed.gz')
+        bgzip(self.bed,bgz)
+        self.assertFalse(gless.Bgzf.check(gz))
+        self.assertTrue(gless.Bgzf.check(bgz))
+        for path in [gz,bgz]:
+            track = gless.Parser(path)
+            self.assertEqual(features(track.read()),features(plain.read()),path)
+            for sel in list(self.selections())[::4]:
+                self.assertEqual(features(track.read(selection=sel),20),
+                                 features(plain.read(selection=sel),20),(path,sel))
+
+    def test_sort(self):
+        """Merging the sorted runs by small groups gives the same file as in one pass."""
+        lines = open(self.bed).readlines()
+        random.seed(2)
+        random.shuffle(lines)
+        unsorted = os.path.join(self.dir,'unsorted.bed')
+        with open(unsorted,'w') as f: f.writelines(['track name=test\n']+lines)
+        self.assertFalse(gless.Index(unsorted).load().sorted)
+        one = gless.sort_track(unsorted,os.path.join(self.dir,'one.bed'),memory=0)
+        passes = gless.sort_track(unsorted,os.path.join(self.dir,'passes.bed'),memory=0,fanin=2)
+        self.assertEqual(open(passes).read(),open(one).read())
+        self.assertTrue(gless.Index(one).load().sorted)
+        self.assertEqual(sorted(open(one).readlines()[1:]),sorted(lines))
+
+    def test_stats(self):
+        """The quantiles of the scores are found within the relative accuracy of `Stats`."""
+        path = os.path.join(self.dir,'test.bedGraph')
+        make_bedgraph(path,5000)
+        scores = sorted(float(l.split('\t')[3]) for l in open(path))
+        stats = gless.Stats(path).load()
+        for q in [0,0.001,0.1,0.5,0.9,0.999,1]:
+            exact = scores[int(q*(len(scores)-1))]
+            self.assertAlmostEqual(stats.quantile(q),exact,delta=abs(exact)*gless.Stats.accuracy+1e-9)
+        stats = gless.Stats(path).load() # from the sidecar file
+        self.assertEqual(stats.quantile(1),scores[-1])
+
+if __name__ == '__main__':
+    unittest.main()
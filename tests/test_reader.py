@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""
+Tests of the Reader of gless.py on small tracks written in a temporary directory.
+
+Usage: python tests/test_reader.py
+"""
+
+import os,sys,imp,shutil,tempfile,unittest
+
+gless = imp.load_source('gless',os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','gless.py'))
+
+# the same chromosomes in opposite orders
+TRACKS = {'o1.bed': [('chr1',0,10,'a1'),('chr1',20,30,'a2'),('chr2',0,10,'b1'),('chr2',15,25,'b2'),
+                     ('chr3',5,15,'c1')],
+          'o2.bed': [('chr3',0,12,'C1'),('chr3',30,40,'C2'),('chr2',2,8,'B1'),('chr1',1,4,'A1'),
+                     ('chr1',12,18,'A2'),('chr1',25,35,'A3')]}
+# the same chromosomes in the same order
+AGREEING = {'a1.bed': TRACKS['o1.bed'], 'a2.bed': sorted(TRACKS['o2.bed'])}
+
+class TestChromosomeOrder(unittest.TestCase):
+    tracks = TRACKS
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = []
+        for name in sorted(self.tracks):
+            path = os.path.join(self.dir,name)
+            with open(path,'w') as f:
+                for x in self.tracks[name]: f.write("%s\t%d\t%d\t%s\n" % x)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def pages(self,nfeat,nbp,sel=None,binary=False):
+        """Read all pages, at most 100, and return their (key, names of the features)."""
+        if binary: tracks = [gless.BinaryTrack(p) for p in self.paths if gless.BinaryTrack.build(p)]
+        else: tracks = [gless.Parser(p) for p in self.paths]
+        reader = gless.Reader(tracks,nfeat,nbp,sel,['intervals']*len(tracks))
+        prefetcher = gless.Prefetcher(reader,reader.read())
+        pages = []
+        for _ in range(100):
+            page = prefetcher.read()
+            if page is None: break
+            pages.append((page[0],set(x[2] for t in page[1] for x in t if x[2] != '00')))
+        return pages
+
+    def check(self,pages,chroms):
+        self.assertTrue(len(pages) < 100, "the pages do not end")
+        shown = [key[0] for key,names in pages]
+        self.assertEqual(sorted(set(shown),key=shown.index),chroms)
+        self.assertEqual(shown,sorted(shown,key=chroms.index)) # each chromosome once
+        names = set().union(*[names for key,names in pages])
+        expected = set(x[3] for t in self.tracks.values() for x in t if x[0] in chroms)
+        self.assertEqual(names,expected)
+
+    def test_nbp(self):
+        for binary in (False,True):
+            self.check(self.pages(None,10,binary=binary),['chr1','chr2','chr3'])
+            self.check(self.pages(None,10,{'chr':'chr2'},binary),['chr2','chr3'])
+
+    def test_nfeat(self):
+        for binary in (False,True):
+            for nfeat in (1,2,5):
+                self.check(self.pages(nfeat,None,binary=binary),['chr1','chr2','chr3'])
+            self.check(self.pages(2,None,{'chr':'chr2'},binary),['chr2','chr3'])
+
+class TestSameOrder(TestChromosomeOrder):
+    tracks = AGREEING
+
+    def test_no_index(self):
+        """The tables of contents are not needed when the tracks agree on the order."""
+        self.check(self.pages(None,10),['chr1','chr2','chr3'])
+        self.check(self.pages(2,None),['chr1','chr2','chr3'])
+        self.assertEqual([f for f in os.listdir(self.dir) if f.endswith('.gli')],[])
+
+class TestBuffer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir,'long.bed')
+        with open(self.path,'w') as f: # a long feature stays in the buffer until the end
+            f.write("chr1\t0\t1000000\tlong\n")
+            for n in range(3000): f.write("chr1\t%d\t%d\tf%d\n" % (10*n,10*n+15,n))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_compact(self):
+        """The rows of the features shown are dropped, and the pages read again are the same."""
+        nfeat = 20
+        reader = gless.Reader([gless.Parser(self.path)],nfeat,None,None,['intervals'])
+        pages = []
+        for content in reader.read():
+            pages.append(((reader.chrom,reader.ntimes),list(content[0])))
+            self.assertTrue(sum(len(b) for b in reader.bufs) <= 4*nfeat+4)
+            reader.next_page()
+        self.assertTrue(reader.epoch > 0)
+        names = set(x[2] for key,page in pages for x in page)
+        self.assertEqual(names,set(['long']+['f%d' % n for n in range(3000)]))
+        for key,page in pages[::50]:
+            self.assertEqual(list(reader.read_page(key)[0]),page)
+
+if __name__ == '__main__':
+    unittest.main()